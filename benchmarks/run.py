@@ -0,0 +1,209 @@
+"""
+Scaling benchmarks of wishbone on synthetic bifurcating trajectories (see synthetic.py).
+
+    python benchmarks/run.py --sizes 10000 100000 1000000 --output results.json
+    python benchmarks/run.py --save-baseline baseline.json
+    python benchmarks/run.py --baseline baseline.json
+
+Every stage runs in a fresh process on freshly generated data, after the stages it
+depends on, so that its peak memory is not hidden by earlier stages. For every stage and
+size the wall time, the CPU time of all threads and the peak resident memory of the
+process are recorded, for core.wishbone also per sub-stage. Like Wishbone.run_wishbone,
+core.wishbone runs on diffusion components of the data, computed before it is timed.
+Baselines are results files of an earlier run on the same machine; stages slower than
+tolerance times their baseline are reported as regressions and make the run exit with
+status 1.
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import get_context
+
+import numpy as np
+
+import synthetic
+
+
+STAGES = ('wishbone', 'run_pca', 'run_diffusion_map', 'run_diffusion_map_correlations')
+
+
+def run_stage(stage, n_cells, options):
+    """ Time one stage on a synthetic dataset of n_cells cells
+    :param stage: One of STAGES
+    :param options: Dictionary of the command line options
+    :return: Dictionary with the wall_time and cpu_time in seconds, the peak_rss of the
+    process and its increase during the stage in bytes, and the wishbone sub-stage events
+    """
+    import wishbone
+    from wishbone.instrument import peak_rss
+
+    data, _, _ = synthetic.bifurcating_trajectory(n_cells, options['dims'], options['noise'],
+        random_state=options['seed'])
+    events = []
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        if stage == 'wishbone':
+            scdata = wishbone.wb.SCData(synthetic.expression_matrix(data), 'sc-seq')
+            del data
+            scdata.run_pca()
+            scdata.run_diffusion_map()
+            components = scdata.diffusion_eigenvectors.ix[:, options['components']].values
+            del scdata
+            def run():
+                wishbone.core.wishbone(components, s=0, k=options['k'], l=options['k'],
+                    num_waypoints=options['num_waypoints'], verbose=False,
+                    n_jobs=options['n_jobs'], random_state=options['seed'],
+                    nn_backend=options['nn_backend'], waypoint_strategy=options['waypoint_strategy'],
+                    landmark_subsample=options['landmark_subsample'], instrument=events.append)
+        else:
+            scdata = wishbone.wb.SCData(synthetic.expression_matrix(data), 'sc-seq')
+            del data
+            if stage != 'run_pca':
+                scdata.run_pca()
+            if stage == 'run_diffusion_map_correlations':
+                scdata.run_diffusion_map()
+            run = getattr(scdata, stage)
+
+        rss = peak_rss()
+        wall, cpu = time.perf_counter(), time.process_time()
+        run()
+        wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+
+    peak = peak_rss()
+    return dict(stage=stage, n_cells=n_cells, wall_time=wall, cpu_time=cpu, peak_rss=peak,
+        peak_rss_increase=None if peak is None else peak - rss,
+        substages=[dict((key, event[key]) for key in ('stage', 'iteration', 'wall_time',
+            'cpu_time', 'peak_rss', 'rss_delta') if key in event) for event in events])
+
+
+def run_benchmarks(options):
+    """ Run every stage at every size, each in a fresh process. Of repeated runs the
+    fastest is kept
+    :return: List of result dictionaries, with an error instead of the timings for the
+    stages that failed, e.g. by running out of memory
+    """
+    results = []
+    for n_cells in options['sizes']:
+        for stage in options['stages']:
+            print('%s on %d cells...' % (stage, n_cells))
+            try:
+                runs = []
+                for _ in range(options['repeats']):
+                    with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as executor:
+                        runs.append(executor.submit(run_stage, stage, n_cells, options).result())
+                result = min(runs, key=lambda run: run['wall_time'])
+            except BrokenProcessPool:
+                result = dict(stage=stage, n_cells=n_cells, error='worker process died, out of memory?')
+            except Exception as e:
+                result = dict(stage=stage, n_cells=n_cells, error='%s: %s' % (type(e).__name__, e))
+            if 'error' in result:
+                print('    failed: %s' % result['error'])
+            else:
+                print('    %.2f s wall, %.2f s cpu, %s peak memory' % (result['wall_time'],
+                    result['cpu_time'], _format_bytes(result['peak_rss'])))
+            results.append(result)
+    return results
+
+
+def environment():
+    """ Description of the machine and library versions the benchmarks ran on
+    """
+    import scipy
+    import sklearn
+    return dict(python=platform.python_version(), platform=platform.platform(),
+        processor=platform.processor(), cpu_count=os.cpu_count(), numpy=np.__version__,
+        scipy=scipy.__version__, sklearn=sklearn.__version__)
+
+
+def compare(results, baseline, tolerance):
+    """ Print the ratio of every result to its baseline of the same stage and size
+    :param results: Results file contents of this run
+    :param baseline: Results file contents of the baseline run
+    :param tolerance: Ratio of the wall time or peak memory to the baseline above which a
+    stage counts as a regression
+    :return: Number of regressions
+    """
+    settings = lambda run: dict((key, value) for key, value in run['options'].items()
+        if key not in ('sizes', 'stages', 'repeats'))
+    if settings(baseline) != settings(results):
+        print('Warning: the baseline was run with different options')
+    if baseline['environment'] != results['environment']:
+        print('Warning: the baseline was run in a different environment')
+
+    reference = dict(((r['stage'], r['n_cells']), r) for r in baseline['results'] if 'error' not in r)
+    regressions = 0
+    print('%-32s %9s %10s %10s %7s %7s' % ('stage', 'cells', 'baseline', 'current', 'time', 'memory'))
+    for result in results['results']:
+        base = reference.get((result['stage'], result['n_cells']))
+        if base is None or 'error' in result:
+            continue
+        time_ratio = result['wall_time'] / base['wall_time']
+        memory_ratio = (result['peak_rss'] / base['peak_rss']
+            if result['peak_rss'] and base['peak_rss'] else np.nan)
+        regression = time_ratio > tolerance or memory_ratio > tolerance
+        regressions += regression
+        print('%-32s %9d %9.2fs %9.2fs %6.2fx %6.2fx%s' % (result['stage'], result['n_cells'],
+            base['wall_time'], result['wall_time'], time_ratio, memory_ratio,
+            '  REGRESSION' if regression else ''))
+    return regressions
+
+
+def _format_bytes(n_bytes):
+    if n_bytes is None:
+        return 'unknown'
+    return '%.1f MB' % (n_bytes / 2 ** 20)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Scaling benchmarks of wishbone on synthetic '
+        'bifurcating trajectories')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000],
+        help='Numbers of cells')
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=list(STAGES))
+    parser.add_argument('--dims', type=int, default=50, help='Number of features (genes)')
+    parser.add_argument('--noise', type=float, default=0.02,
+        help='Standard deviation of the noise, relative to a trajectory of length 1')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeats', type=int, default=1,
+        help='Runs of every stage, the fastest is kept')
+    parser.add_argument('--k', type=int, default=15, help='Nearest neighbors of wishbone')
+    parser.add_argument('--components', type=int, nargs='+', default=[1, 2, 3],
+        help='Diffusion components wishbone runs on')
+    parser.add_argument('--num-waypoints', type=int, default=250)
+    parser.add_argument('--n-jobs', type=int, default=1)
+    parser.add_argument('--nn-backend', default='exact', choices=('exact', 'approximate'))
+    parser.add_argument('--waypoint-strategy', default='random',
+        choices=('random', 'farthest', 'density'))
+    parser.add_argument('--landmark-subsample', type=int, default=None)
+    parser.add_argument('--output', help='Write the results to this JSON file')
+    parser.add_argument('--baseline', help='Compare against this results file')
+    parser.add_argument('--save-baseline', help='Write the results to this file as a new baseline')
+    parser.add_argument('--tolerance', type=float, default=1.25,
+        help='Ratio to the baseline above which a stage is a regression')
+    args = parser.parse_args(argv)
+
+    options = dict((key, value) for key, value in vars(args).items()
+        if key not in ('output', 'baseline', 'save_baseline', 'tolerance'))
+    results = dict(environment=environment(), options=options,
+        results=run_benchmarks(options))
+
+    for path in (args.output, args.save_baseline):
+        if path is not None:
+            with open(path, 'w') as f:
+                json.dump(results, f, indent=1)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.tolerance) > 0:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,49 @@
+import numpy as np
+import pandas as pd
+from sklearn.utils import check_random_state
+
+
+def bifurcating_trajectory(n_cells, n_dims=50, noise=0.02, branch_point=0.4,
+    random_state=None):
+    """ Cells along a trunk that bifurcates into two branches. The trajectory lies in a
+    random 2 dimensional subspace of the n_dims features and has length 1.
+    :param n_cells: Number of cells
+    :param n_dims: Number of features, at least 2
+    :param noise: Standard deviation of the gaussian noise added to every feature
+    :param branch_point: Pseudotime of the bifurcation, between 0 and 1
+    :param random_state: None, int or np.random.RandomState
+    :return: cells x features array, pseudotime and branch (1 for the trunk, 2 and 3 for
+    the branches) of every cell. The first cell is the start of the trunk
+    """
+    if n_dims < 2:
+        raise ValueError('n_dims must be at least 2')
+    if not 0 < branch_point < 1:
+        raise ValueError('branch_point must be between 0 and 1')
+    random_state = check_random_state(random_state)
+
+    pseudotime = np.sort(random_state.rand(n_cells))
+    pseudotime[0] = 0
+    branch = np.ones(n_cells, dtype=int)
+    after = pseudotime > branch_point
+    branch[after] = 2 + random_state.randint(2, size=np.sum(after))
+
+    # Trunk along the first axis, the branches diverge at 45 degrees to either side
+    progress = np.maximum(pseudotime - branch_point, 0)
+    latent = np.empty((n_cells, 2))
+    latent[:, 0] = np.minimum(pseudotime, branch_point) + progress * np.sqrt(0.5)
+    latent[:, 1] = np.where(branch == 2, 1, -1) * progress * np.sqrt(0.5)
+
+    basis, _ = np.linalg.qr(random_state.randn(n_dims, 2))
+    data = np.dot(latent, basis.T)
+    data += noise * random_state.randn(n_cells, n_dims)
+    return data, pseudotime, branch
+
+
+def expression_matrix(data):
+    """ Non-negative cells x genes DataFrame of data for wishbone.wb.SCData
+    :param data: cells x features array
+    :return: DataFrame with cell_<i> rows and gene_<j> columns
+    """
+    return pd.DataFrame(data - np.min(data),
+        index=['cell_%d' % i for i in range(data.shape[0])],
+        columns=['gene_%d' % j for j in range(data.shape[1])])
@@ -25,7 +25,6 @@ setup(name='wishbone',
           'matplotlib>=2.0.0',
           'seaborn>=0.7.1',
           'sklearn',
-          'networkx>=1.11',
           'fcsparser>=0.1.2',
           'statsmodels>=0.8.0'],
       scripts=['src/wishbone/wishbone_gui.py'],
@@ -1,5 +1,7 @@
 from . import wishbone_gui
 from . import wb
+from . import neighbors
+from . import instrument
 from . import core
 from . import autocomplete_entry
 
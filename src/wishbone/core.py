@@ -1,21 +1,49 @@
 import numpy as np
+import os
 import time
-import sys
+import hashlib
+import numbers
+import tempfile
+import threading
 import warnings
-from numpy import matlib
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from multiprocessing import shared_memory
 
 from sklearn.neighbors import NearestNeighbors
+from sklearn.utils import check_random_state
+
+from wishbone.neighbors import ApproximateNeighbors
+from wishbone.instrument import Instrumentation
 from scipy import sparse, stats
 from scipy.sparse import csgraph
 from numpy import linalg
-from scipy.sparse.linalg import norm
+from scipy.sparse.linalg import norm, eigsh, ArpackNoConvergence
 from scipy.sparse.csgraph import dijkstra
-import networkx as nx
 
 def wishbone(data, s, k=15, l=15, num_graphs=1, num_waypoints=250, 
 	verbose=True, metric='euclidean', voting_scheme='exponential', 
 	branch=True, flock_waypoints=2, band_sample=False, partial_order=[],
-	search_connected_components=True):
+	search_connected_components=True, n_jobs=1, random_state=None,
+	max_iterations=15, convergence_threshold=0.9999, realign_tol=None, acceleration=None,
+	memory_limit=None, dtype=np.float64, nn_backend='exact', cache=None,
+	waypoint_strategy='random', landmark_subsample=None, keep_landmarks=False,
+	instrument=None, progress=None, cancel=None):
+	""" Wishbone trajectory and branches of the cells in data from start cell s. The
+	parameters of the iterative refinement (max_iterations, convergence_threshold,
+	realign_tol, acceleration, memory_limit, landmark_subsample, ...) are described in
+	_wishbone_graph. realign_tol is relative to the trajectory range, so that it does
+	not depend on the scale of the shortest path distances.
+	:return: Dictionary with the Trajectory, Waypoints, Branches and BAS, and the
+	Landmarks state for project_cells if keep_landmarks
+	"""
+	if acceleration not in (None, 'damping', 'anderson'):
+		raise ValueError('acceleration must be None, \'damping\' or \'anderson\'')
+	if waypoint_strategy not in _WAYPOINT_STRATEGIES:
+		raise ValueError('waypoint_strategy must be \'random\', \'farthest\' or \'density\'')
+	if keep_landmarks and num_graphs > 1:
+		raise ValueError('keep_landmarks requires num_graphs=1')
+	instrument = _instrumentation(instrument, progress, cancel)
 
 	if verbose:
 		print('Building lNN graph...')
@@ -23,129 +51,731 @@ def wishbone(data, s, k=15, l=15, num_graphs=1, num_waypoints=250,
 
 	# Construct nearest neighbors graph
 	start = time.process_time()
-	nbrs = NearestNeighbors(n_neighbors=l+1, metric=metric).fit(data)  
-	lnn = nbrs.kneighbors_graph(data, mode='distance' ) 
-	lnn = np.transpose(lnn)
+	data = np.asarray(data, dtype=dtype)
+	n_jobs = _effective_n_jobs(n_jobs)
+	with instrument.stage('lnn'):
+		nbrs, lnn, graph_key = _lnn_graph(data, k, l, metric, n_jobs, random_state, nn_backend, cache)
 	print('lNN computed in : %.2f seconds' % (time.process_time()-start))
 
-	#set up return structure
-	trajectory = []
-	waypoints = []
-	branches = []
-	bas = []
+	# Each klNN graph gets its own random stream so that replicates are
+	# reproducible independently of the order in which workers run them
+	if num_graphs == 1:
+		random_states = [check_random_state(random_state)]
+	else:
+		seeds = check_random_state(random_state).randint(np.iinfo(np.int32).max, size=num_graphs)
+		random_states = [np.random.RandomState(seed) for seed in seeds]
+
+	# generate klNN graphs and iteratively refine a trajectory in each,
+	# splitting the workers between concurrent graphs and their landmarks
+	graph_jobs = min(n_jobs, num_graphs)
+	landmark_jobs = max(1, n_jobs // graph_jobs)
+	def run_graph(graph_iter):
+		return _wishbone_graph(lnn, nbrs, data, s, k, l, num_waypoints, verbose, metric,
+			voting_scheme, branch, flock_waypoints, band_sample, waypoint_strategy, partial_order,
+			landmark_jobs, random_states[graph_iter], max_iterations,
+			convergence_threshold, realign_tol, acceleration, memory_limit, cache, graph_key,
+			landmark_subsample, keep_landmarks, search_connected_components,
+			instrument.bind(graph=graph_iter), landmark_jobs if graph_jobs > 1 else None)
+
+	if graph_jobs > 1:
+		with ThreadPoolExecutor(max_workers=graph_jobs) as executor:
+			results = list(executor.map(run_graph, range(num_graphs)))
+	else:
+		results = [run_graph(graph_iter) for graph_iter in range(num_graphs)]
+
+	trajectory, waypoints, branches, bas = _consensus(results, branch)
+	instrument.save()
+	res = dict(zip(['Trajectory', 'Waypoints', 'Branches', 'BAS'],
+	  [trajectory, waypoints, branches, bas]))
+	if keep_landmarks:
+		res['Landmarks'] = results[0][4]
+	return res
+
+
+def project_cells(landmarks, neighbor_dist, neighbor_idx):
+	""" Place new cells on a fitted trajectory. Their shortest path distances to the
+	landmarks run through their nearest fitted cells, and the new cells then take
+	the landmarks' votes like fitted cells do in the last iteration of the fit. A cell
+	joins the branch of its closest landmark, and the votes of landmarks on the other
+	side of the branch split are muted by the branch association scores as in the fit.
+	Fitted cells projected through themselves keep their position, up to the mixing of
+	an acceleration and the perspectives realigned within realign_tol.
+	:param landmarks: Landmark state returned by wishbone with keep_landmarks=True
+	:param neighbor_dist: New cells x k distances to their nearest fitted cells, in the
+	space wishbone was run on
+	:param neighbor_idx: New cells x k indices of these fitted cells
+	:return: Trajectory (on the scale of the fitted trajectory) and branches (None if
+	fitted without branches) of the new cells
+	"""
+	dist, t, l = landmarks['dist'], landmarks['trajectory'], landmarks['waypoints']
+	t_prev = landmarks['aligned_to']
+	neighbor_idx = np.asarray(neighbor_idx)
+	neighbor_dist = np.asarray(neighbor_dist, dtype=dist.dtype)
+
+	# shortest path distances from the landmarks through the nearest fitted cells
+	d = dist[:, neighbor_idx[:, 0]] + neighbor_dist[:, 0]
+	for j in range(1, neighbor_idx.shape[1]):
+		np.minimum(d, dist[:, neighbor_idx[:, j]] + neighbor_dist[:, j], out=d)
+
+	# align the landmark perspectives to the positions of the nearest fitted cells
+	with warnings.catch_warnings():
+		warnings.simplefilter('ignore', RuntimeWarning)
+		position = np.nanmean(t_prev[neighbor_idx], axis=1)
+	before = position[np.newaxis, :] < t_prev[l][:, np.newaxis]
+	perspectives = landmarks['origins'][:, np.newaxis] + np.where(before, -d, d)
+	W = _voting_weights(landmarks['voting_scheme'], d, landmarks['voting_scale'], np.empty_like(d))
+
+	branches = None
+	if landmarks['branches'] is not None:
+		closest = np.argmin(d, axis=0)
+		branches = landmarks['branches'][closest]
+		muting = landmarks['muting']
+
+		# branch association scores, from the perspective of the start landmark as in
+		# _splittobranches. Cells without defined affinities take that of their closest landmark
+		Y = np.dot(_stochastic_affinity(d, muting['sigma']).T, muting['evec2'])
+		Y = _scale_bas(Y * np.power(perspectives[0], 0.7), *muting['scaling'])
+		undefined = np.isnan(Y)
+		Y[undefined] = muting['landmark_bas'][closest[undefined]]
+
+		# mute the votes across the split like _muteCrossBranchVoting
+		if muting['bandwidth'] > 0:
+			landmark_mute = np.exp(-0.5*np.power(muting['landmark_bas'], 2) / muting['bandwidth'])
+			cell_mute = np.exp(-0.5*np.power(Y, 2) / muting['bandwidth'])
+			crossb = np.sign(muting['landmark_bas'])[:, np.newaxis] != np.sign(Y)[np.newaxis, :]
+			np.multiply(W, np.maximum(landmark_mute[:, np.newaxis], cell_mute[np.newaxis, :]),
+				out=W, where=crossb)
+			W /= W.sum(axis=0)
+
+	trajectory = np.sum(W * perspectives, axis=0)
+	return (trajectory - np.nanmin(t)) / (np.nanmax(t) - np.nanmin(t)), branches
+
+
+def wishbone_batch(data, starts, k=15, l=15, num_waypoints=250, verbose=True,
+	metric='euclidean', voting_scheme='exponential', branch=True, flock_waypoints=2,
+	band_sample=False, n_jobs=1, random_state=None, max_iterations=15,
+	convergence_threshold=0.9999, realign_tol=None, acceleration=None,
+	memory_limit=None, dtype=np.float64, nn_backend='exact', cache=None,
+	waypoint_strategy='random', landmark_subsample=None, search_connected_components=True,
+	instrument=None, progress=None, cancel=None):
+	""" Run wishbone from several start cells. The lNN and klNN graphs, the waypoints
+	and their shortest paths are computed once and shared by all start cells, only the
+	start cell's shortest paths and the iterative refinement are repeated per start.
+	:param starts: Indices of the start cells
+	:param instrument: See _instrumentation. Events of the refinement carry the start index
+	:param progress: Progress callback, see wishbone.instrument.Instrumentation
+	:param cancel: wishbone.instrument.CancelToken stopping the run
+	:return: List with the result dictionary of wishbone for every start cell
+	"""
+	if acceleration not in (None, 'damping', 'anderson'):
+		raise ValueError('acceleration must be None, \'damping\' or \'anderson\'')
+	if waypoint_strategy not in _WAYPOINT_STRATEGIES:
+		raise ValueError('waypoint_strategy must be \'random\', \'farthest\' or \'density\'')
+	starts = np.asarray(starts, dtype=int).ravel()
+	if len(starts) == 0:
+		raise ValueError('starts must contain at least one cell')
+	instrument = _instrumentation(instrument, progress, cancel)
+
+	if verbose:
+		print('Building lNN graph...')
+	start = time.process_time()
+	data = np.asarray(data, dtype=dtype)
+	n_jobs = _effective_n_jobs(n_jobs)
+	with instrument.stage('lnn'):
+		nbrs, lnn, graph_key = _lnn_graph(data, k, l, metric, n_jobs, random_state, nn_backend, cache)
+	print('lNN computed in : %.2f seconds' % (time.process_time()-start))
 
-	# generate klNN graphs and iteratively refine a trajectory in each
-	for graph_iter in range(num_graphs):
+	random_state = check_random_state(random_state)
+	with instrument.stage('klnn'):
+		klnn = _klnn_graph(lnn, k, l, verbose, random_state, cache, graph_key)
+	n_cells = len(data)
+	with instrument.stage('components'):
+		cells = _start_component(klnn, starts) if search_connected_components else None
+	if cells is not None:
+		position = _component_positions(cells, n_cells)
+		klnn, data, starts = klnn[cells][:, cells], data[cells], position[starts]
+		nbrs = None
+		graph_key = GraphCache.key('component', graph_key, cells) if graph_key is not None else None
+
+	# Waypoints are drawn once, relative to the first start cell
+	if verbose:
+		print('Determining waypoints and shortest path distances...')
+	space = _Workspace(memory_limit)
+	try:
+		with instrument.stage('waypoints'):
+			_, waypoints = _select_waypoints(klnn, data, starts[:1], num_waypoints, [], metric,
+				flock_waypoints, band_sample, waypoint_strategy, branch, n_jobs, random_state,
+				nbrs, cache, graph_key, instrument)
+		waypoints = np.asarray(waypoints, dtype=int)
+		with instrument.stage('shortest_paths'):
+			wp_dist, wp_predecessors = _landmark_shortest_paths(klnn, waypoints, n_jobs, space,
+				cache, graph_key, patch_unreachable=cells is None, instrument=instrument)
+			start_dist, start_predecessors = _landmark_shortest_paths(klnn, starts, n_jobs, space,
+				cache, graph_key, patch_unreachable=cells is None)
+
+		# Workers are split between concurrent start cells and their landmarks
+		start_jobs = min(n_jobs, len(starts))
+		landmark_jobs = max(1, n_jobs // start_jobs)
+		advance = instrument.counter('starts', len(starts))
+		def run_start(i):
+			start_space = _Workspace(memory_limit)
+			start_instrument = instrument.bind(start=i)
+			try:
+				s = starts[i]
+				iter_l = np.append(s, waypoints).astype(int)
+				dist = start_space.empty((len(iter_l), len(data)), wp_dist.dtype)
+				dist[0] = start_dist[i]
+				dist[1:] = wp_dist
+				predecessors = start_space.empty(dist.shape, wp_predecessors.dtype)
+				predecessors[0] = start_predecessors[i]
+				predecessors[1:] = wp_predecessors
+				with start_instrument.stage('perspectives'):
+					traj = _landmark_perspectives(dist, iter_l, [s], landmark_jobs, start_space)
+				result = _iterate_trajectory(traj, dist, iter_l, predecessors, data, s, verbose,
+					voting_scheme, branch, landmark_jobs, max_iterations,
+					convergence_threshold, realign_tol, acceleration, start_space,
+					landmark_subsample, instrument=start_instrument)
+				advance(1)
+				return _expand_result(result, cells, n_cells) if cells is not None else result
+			finally:
+				start_space.close()
+
+		if start_jobs > 1:
+			with ThreadPoolExecutor(max_workers=start_jobs) as executor:
+				results = list(executor.map(run_start, range(len(starts))))
+		else:
+			results = [run_start(i) for i in range(len(starts))]
+	finally:
+		space.close()
+	instrument.save()
+
+	return [dict(zip(['Trajectory', 'Waypoints', 'Branches', 'BAS'], result[:4]))
+		for result in results]
+
+
+def _wishbone_graph(lnn, nbrs, data, s, k, l, num_waypoints, verbose, metric,
+	voting_scheme, branch, flock_waypoints, band_sample, waypoint_strategy, partial_order,
+	n_jobs, random_state, max_iterations=15, convergence_threshold=0.9999,
+	realign_tol=None, acceleration=None, memory_limit=None, cache=None, graph_key=None,
+	landmark_subsample=None, keep_landmarks=False, search_connected_components=True,
+	instrument=None, processes=None):
+	""" Generate one klNN graph from the shared lNN graph and iteratively refine a
+	trajectory in it
+	:param nbrs: Fitted neighbor index of data, shared with waypoint flocking
+	:param waypoint_strategy: 'random', 'farthest' or 'density', see _select_waypoints
+	:param max_iterations: Maximum number of realignment iterations
+	:param convergence_threshold: Stop once the correlation between a trajectory and the
+	one computed from the perspectives realigned to it exceeds this value
+	:param realign_tol: If not None, only realign the perspectives of landmarks whose
+	position moved by more than this fraction of the trajectory range (e.g. 0.001) since
+	their last realignment
+	:param acceleration: None, 'damping' or 'anderson' mixing of the fixed-point iterates.
+	On synthetic bifurcations 'anderson' converges in about as many iterations as none and
+	'damping' takes about twice as many, in exchange for damping oscillating runs
+	:param memory_limit: Approximate cap in bytes on the L x N matrices held in memory
+	:param cache: GraphCache for the undirected klNN graph and shortest path rows
+	:param graph_key: Cache key of the klNN graph, None if it can not be cached
+	:param landmark_subsample: If not None, iterate on about this many cells around the
+	landmarks only and extend the result to all cells in a final pass
+	:param keep_landmarks: Also return the landmark state needed by project_cells
+	:param search_connected_components: Only solve the connected component of the start
+	cell. Other cells get a NaN trajectory and branch 0. Otherwise the whole graph is
+	solved with infinite distances patched, and no branch is found if no path connects
+	the branch ends
+	:param instrument: Instrumentation receiving the stage events
+	:param processes: Worker processes of the shortest paths, see _landmark_shortest_paths.
+	At least one while other graphs run in threads, which the solver would block
+	:return: Normalized trajectory, waypoints, branches, BAS (None without branch) and
+	landmark state (None unless keep_landmarks)
+	"""
+	space = _Workspace(memory_limit)
+	instrument = instrument if instrument is not None else Instrumentation()
+	try:
+		with instrument.stage('run'):
+			return _refine_trajectory(lnn, nbrs, data, s, k, l, num_waypoints, verbose, metric,
+				voting_scheme, branch, flock_waypoints, band_sample, waypoint_strategy, partial_order,
+				n_jobs, random_state, max_iterations, convergence_threshold,
+				realign_tol, acceleration, space, cache, graph_key, landmark_subsample,
+				keep_landmarks, search_connected_components, instrument, processes)
+	finally:
+		space.close()
+
+
+def _refine_trajectory(lnn, nbrs, data, s, k, l, num_waypoints, verbose, metric,
+	voting_scheme, branch, flock_waypoints, band_sample, waypoint_strategy, partial_order,
+	n_jobs, random_state, max_iterations, convergence_threshold,
+	realign_tol, acceleration, space, cache, graph_key, landmark_subsample=None,
+	keep_landmarks=False, search_connected_components=True, instrument=None, processes=None):
+	instrument = instrument if instrument is not None else Instrumentation()
+	with instrument.stage('klnn'):
+		klnn = _klnn_graph(lnn, k, l, verbose, random_state, cache, graph_key)
+
+	# restrict the solve to the connected component of the start cell
+	with instrument.stage('components'):
+		cells = _start_component(klnn, [s]) if search_connected_components else None
+	if cells is not None:
+		position = _component_positions(cells, len(data))
+		klnn, data, s = klnn[cells][:, cells], data[cells], position[s]
+		partial_order = _component_cells(partial_order, position)
+		if not isinstance(num_waypoints, int):
+			num_waypoints = list(_component_cells(num_waypoints, position))
+		# the neighbor index covers the dropped cells, flocking needs one of the component
+		nbrs = None
+		graph_key = GraphCache.key('component', graph_key, cells) if graph_key is not None else None
+
+	#run traj. landmarks
+	traj, dist, iter_l, predecessors = _trajectory_landmarks( klnn, data, [s], num_waypoints, partial_order, verbose, metric, flock_waypoints, band_sample, branch, n_jobs, random_state, space, nbrs, cache, graph_key, waypoint_strategy, search_connected_components, instrument, processes)
+	result = _iterate_trajectory(traj, dist, iter_l, predecessors, data, s, verbose,
+		voting_scheme, branch, n_jobs, max_iterations, convergence_threshold,
+		realign_tol, acceleration, space, landmark_subsample, keep_landmarks, instrument)
+	if cells is not None:
+		result = _expand_result(result, cells, len(position))
+	return result
+
+
+def _start_component(spdists, starts):
+	""" Cells in the connected component of the start cells
+	:return: Sorted indices of the cells, None if the graph is connected
+	"""
+	n_components, labels = csgraph.connected_components(spdists, directed=False)
+	if n_components == 1:
+		return None
+	label = labels[starts[0]]
+	if np.any(labels[starts] != label):
+		raise RuntimeError('Start cells lie in different connected components of the graph')
+	cells = np.where(labels == label)[0]
+	warnings.warn('The graph has %d connected components. The %d cells outside the component '
+		'of the start cell are dropped and get a NaN trajectory and branch 0' %
+		(n_components, len(labels) - len(cells)))
+	return cells
+
+
+def _component_positions(cells, n_cells):
+	# position of every cell in the component, -1 for dropped cells
+	position = np.full(n_cells, -1, dtype=int)
+	position[cells] = np.arange(len(cells))
+	return position
+
+
+def _component_cells(indices, position):
+	# positions of the given cells within the component, dropping those outside of it
+	indices = position[np.asarray(indices, dtype=int)]
+	if np.any(indices < 0):
+		warnings.warn('%d specified cells outside the component of the start cell are ignored' %
+			np.sum(indices < 0))
+	return indices[indices >= 0]
+
+
+def _expand_result(result, cells, n_cells):
+	""" Scatter the result of a solve on the cells of one component to all cells
+	:param result: Trajectory, waypoints, branches, BAS and landmark state on the component
+	:return: Result on all cells, NaN trajectory and BAS and branch 0 for dropped cells
+	"""
+	iter_traj, iter_l, RNK, Y, landmarks = result
+	trajectory = np.full(n_cells, np.nan)
+	trajectory[cells] = iter_traj
+	if RNK is not None:
+		branches, bas = np.zeros(n_cells), np.full(n_cells, np.nan)
+		branches[cells], bas[cells] = RNK, Y
+		RNK, Y = branches, bas
+	if landmarks is not None:
+		landmarks = dict(landmarks, waypoints=cells[landmarks['waypoints']])
+		for key in ('dist', 'trajectory', 'aligned_to'):
+			value = landmarks[key]
+			landmarks[key] = np.full(value.shape[:-1] + (n_cells,),
+				np.inf if key == 'dist' else np.nan, dtype=value.dtype)
+			landmarks[key][..., cells] = value
+	return trajectory, cells[iter_l], RNK, Y, landmarks
+
+
+def _klnn_graph(lnn, k, l, verbose, random_state, cache=None, graph_key=None):
+	# undirected klNN graph from the lNN graph
+	klnn = cache.get(graph_key) if graph_key is not None else None
+	if klnn is None:
 		if k!=l:
-			klnn = _spdists_klnn(lnn, k, verbose)
+			klnn = _spdists_klnn(lnn, k, verbose, random_state)
 		else:
-			klnn = lnn
+			klnn = lnn.copy()
 
 		# Make the graph undirected
 		klnn = _spdists_undirected(klnn)
 		klnn.setdiag(0)
 		klnn.eliminate_zeros()
-
-		#run traj. landmarks
-		traj, dist, iter_l, paths_l2l = _trajectory_landmarks( klnn, data, [s], num_waypoints, partial_order, verbose, metric, flock_waypoints, band_sample, branch)
-		if branch:
-			if verbose:
-				print ('Determining branch point and branch associations...')
-			RNK, bp, diffdists, Y = _splittobranches(traj, traj[0], data, iter_l, dist, paths_l2l)
-
-
-		# calculate weighed trajectory
-		W_full = _weighting_scheme(voting_scheme, dist)
-
+		if graph_key is not None:
+			cache.put(graph_key, klnn, _nbytes(klnn))
+	return klnn
+
+
+def _iterate_trajectory(traj, dist, iter_l, predecessors, data, s, verbose,
+	voting_scheme, branch, n_jobs, max_iterations, convergence_threshold,
+	realign_tol, acceleration, space, landmark_subsample=None, keep_landmarks=False,
+	instrument=None):
+	""" Iteratively realign the landmark perspectives into a trajectory
+	:param landmark_subsample: If not None, iterate on about this many cells around the
+	landmarks only and extend the converged landmark positions to all cells afterwards
+	:param keep_landmarks: Also return the landmark state needed by project_cells
+	:param instrument: Instrumentation receiving the stage events
+	:return: Normalized trajectory, waypoints, branches, BAS (None without branch) and
+	the landmark state (None unless keep_landmarks)
+	"""
+	instrument = instrument if instrument is not None else Instrumentation()
+	if landmark_subsample is None or landmark_subsample >= dist.shape[1]:
+		t, t_prev, traj, evec2 = _realignment_loop(traj, dist, iter_l, predecessors, data, s, verbose,
+			voting_scheme, branch, n_jobs, max_iterations, convergence_threshold,
+			realign_tol, acceleration, space, None, instrument)
+	else:
+		cells = _landmark_neighborhoods(dist, iter_l, landmark_subsample, space)
+		sub_l = np.searchsorted(cells, iter_l)
+		if verbose:
+			print('Iterating on %d of %d cells...' % (len(cells), dist.shape[1]))
+		t_sub, _, _, evec2 = _realignment_loop(np.take(traj, cells, axis=1),
+			np.take(dist, cells, axis=1), sub_l, predecessors, data[cells], sub_l[0], verbose,
+			voting_scheme, branch, n_jobs, max_iterations, convergence_threshold,
+			realign_tol, acceleration, _Workspace(), cells, instrument)
+		with instrument.stage('extension'):
+			t, t_prev, traj, evec2 = _extend_trajectory(t_sub[sub_l], traj, dist, iter_l, predecessors,
+				data, s, voting_scheme, branch, n_jobs, space, evec2,
+				instrument.counter('extension', _EXTENSION_PASSES))
+
+	# Normalize the iter_trajectory
+	iter_traj = (t - t.min()) / (t.max() - t.min())
+
+	RNK, Y, sigma = None, None, None
+	if branch:
+		# Recalculate branches post reassignments
+		sigma = _affinity_sigma(dist, space)
+		with instrument.stage('branch_split', final=True):
+			RNK, bp, diffdists, Y, evec2 = _splittobranches(traj, traj[0], data, iter_l, dist, predecessors, space, evec2, None, sigma)
+
+	landmarks = None
+	if keep_landmarks:
+		# perspective of landmark i is its origin, shifted by the distance to a cell, and
+		# negated for the cells before it in the iterate the perspectives were aligned to
+		# dist is referenced if resident, scratch files of memory mapped ones are closed
+		landmarks = dict(waypoints=np.copy(iter_l),
+			dist=np.array(dist) if isinstance(dist, np.memmap) else dist,
+			origins=np.array(traj[np.arange(len(iter_l)), iter_l]), trajectory=np.array(t),
+			aligned_to=np.array(t_prev), voting_scheme=voting_scheme,
+			branches=RNK[iter_l] if branch else None, muting=None,
+			voting_scale=_voting_scale(voting_scheme, dist, space.blocks(*dist.shape)))
 		if branch:
-			W = _muteCrossBranchVoting(W_full, RNK, RNK[s], iter_l, Y)
-		else:
-			W = W_full
+			# what new cells need to mute the cross branch votes like _muteCrossBranchVoting
+			Y_scale, scaling, bandwidth = _bas_scaling(Y, iter_l)
+			landmarks['muting'] = dict(sigma=sigma, evec2=np.copy(evec2), scaling=scaling,
+				bandwidth=bandwidth, landmark_bas=Y_scale[iter_l])
+	return iter_traj, iter_l, RNK, Y, landmarks
+
+
+def _realignment_loop(traj, dist, iter_l, predecessors, data, s, verbose,
+	voting_scheme, branch, n_jobs, max_iterations, convergence_threshold,
+	realign_tol, acceleration, space, cells=None, instrument=None):
+	""" Fixed-point iteration of the trajectory and the landmark perspectives
+	:param cells: Cells of the columns of traj and dist if they are a subsample
+	:param instrument: Instrumentation receiving the stage events
+	:return: Trajectory (not normalized), the previous iterate the perspectives were
+	realigned to, realigned perspectives and the branch eigenvector
+	"""
+	instrument = instrument if instrument is not None else Instrumentation()
+	evec2, sigma = None, None
+	if branch:
+		if verbose:
+			print ('Determining branch point and branch associations...')
+		# the affinities of the branch split only depend on dist, which stays fixed
+		sigma = _affinity_sigma(dist, space)
+		with instrument.stage('branch_split', iteration=1):
+			RNK, bp, diffdists, Y, evec2 = _splittobranches(traj, traj[0], data, iter_l, dist, predecessors, space, None, cells, sigma)
 
-		
-		# save initial solution - start point's shortest path distances
-		t = traj[0, :]
-		t = [t, np.sum(np.multiply(traj, W), axis=0)]
 
-		# iteratively realign trajectory (because landmarks moved)
-		converged, user_break, realign_iter = False, False, 1
-		if verbose:
-			print('Running iterations...')
+	# calculate weighed trajectory
+	with instrument.stage('weighting'):
+		W_full = _weighting_scheme(voting_scheme, dist, space)
 
-		while converged == False and user_break == False:
-			realign_iter = realign_iter + 1
-			print('Iteration: %d' % realign_iter)
+	if branch:
+		with instrument.stage('muting', iteration=1):
+			W = _muteCrossBranchVoting(W_full, RNK, RNK[s], iter_l, Y, space)
+	else:
+		W = W_full
 
-			np.copyto(traj, dist)
-			traj = _realign_trajectory(t, dist, iter_l, traj, 0, len(dist), realign_iter)
+	
+	# save initial solution - start point's shortest path distances.
+	# Only the iterates needed by the convergence check and the mixing are kept
+	history = _ANDERSON_DEPTH + 1 if acceleration == 'anderson' else 2
+	t = deque([np.copy(traj[0, :]), _weighted_trajectory(traj, W, space)], maxlen=history)
+
+	# iteratively realign trajectory (because landmarks moved)
+	converged, user_break, realign_iter = False, False, 1
+	positions, shift, outputs = None, 0, deque([t[1]], maxlen=history)
+	if verbose:
+		print('Running iterations...')
+
+	while converged == False and user_break == False:
+		realign_iter = realign_iter + 1
+		print('Iteration: %d' % realign_iter)
+		with instrument.stage('iteration', iteration=realign_iter):
+			with instrument.stage('realign', iteration=realign_iter):
+				if realign_tol is None:
+					traj = _realign_trajectory(t, dist, iter_l, traj, 0, len(dist), len(t), n_jobs, space)
+				else:
+					positions, shift = _realign_incremental(t[-1], dist, iter_l, traj,
+						positions, shift, realign_tol, space)
 
 			if branch:
-				RNK, bp, diffdists, Y = _splittobranches(traj, traj[0],data, iter_l, dist,paths_l2l)
-				W = _muteCrossBranchVoting(W_full, RNK, RNK[s], iter_l,Y)
+				with instrument.stage('branch_split', iteration=realign_iter):
+					RNK, bp, diffdists, Y, evec2 = _splittobranches(traj, traj[0],data, iter_l, dist, predecessors, space, evec2, cells, sigma)
+				with instrument.stage('muting', iteration=realign_iter):
+					W = _muteCrossBranchVoting(W_full, RNK, RNK[s], iter_l,Y, space, W)
 			# calculate weighed trajectory
-			t.append(np.sum(np.multiply(traj, W), axis=0))
+			outputs.append(_weighted_trajectory(traj, W, space))
+			if acceleration == 'damping':
+				t.append(_DAMPING * outputs[-1] + (1 - _DAMPING) * t[-1])
+			elif acceleration == 'anderson':
+				t.append(_anderson_mixing(list(t)[-_ANDERSON_DEPTH-1:], list(outputs)))
+			else:
+				t.append(outputs[-1])
 			
-			#check for convergence
-			fpoint_corr = stats.pearsonr(np.transpose(t[realign_iter]), np.transpose(t[realign_iter - 1]))[0]
-			if verbose:
-				print('Correlation with previous iteration:  %.4f' % fpoint_corr)
-			converged = fpoint_corr > 0.9999
-		
-			if (realign_iter % 16) == 0:
-				# break after too many alignments - something is wrong
-				user_break = True
-				print('\nWarning: Force exit after ' + str(realign_iter) + ' iterations')
-
-		print(str(realign_iter-1) + ' realignment iterations')
-
-		# save final trajectory for this graph			
-		iter_traj = t[realign_iter][:]
-		# Normalize the iter_trajectory
-		iter_traj = (iter_traj - iter_traj.min()) / (iter_traj.max() - iter_traj.min())
-		trajectory.append(iter_traj)
-		waypoints.append(iter_l)
-		
+			#check for convergence of the trajectory the perspectives were realigned to,
+			#not of the mixed iterates, which move less than the fixed-point residual
+			fpoint_corr = stats.pearsonr(np.transpose(outputs[-1]), np.transpose(t[-2]))[0]
+		if verbose:
+			print('Correlation with previous iteration:  %.4f' % fpoint_corr)
+		converged = fpoint_corr > convergence_threshold
+		# fraction of the iteration budget, the run may converge before using all of it
+		instrument.update('iterations', 1.0 if converged else min(1.0, (realign_iter - 1) / max_iterations))
+	
+		if realign_iter > max_iterations:
+			# break after too many alignments - something is wrong
+			user_break = True
+			print('\nWarning: Force exit after ' + str(realign_iter) + ' iterations')
+
+	print(str(realign_iter-1) + ' realignment iterations')
+
+	return t[-1], t[-2], traj, evec2
+
+
+def _landmark_neighborhoods(dist, l, n_cells, space=None):
+	""" Subsample of cells: the landmarks and the cells closest to each landmark, about
+	n_cells in total
+	:return: Sorted indices of the cells
+	"""
+	space = space if space is not None else _Workspace()
+	cells = [np.asarray(l)]
+	n_closest = int(np.ceil(max(0, n_cells - len(l)) / len(l)))
+	if n_closest > 0:
+		# a few rows at a time, the int64 partition indices are as large as the rows or larger
+		def closest(rows):
+			cells.append(np.argpartition(dist[rows], n_closest - 1, axis=1)[:, :n_closest].ravel())
+		_map_row_chunks(closest, np.arange(len(l)), 1,
+			min(_PROGRESS_ROWS, space.max_rows(dist.shape[1]) or _PROGRESS_ROWS))
+	return np.unique(np.concatenate(cells))
+
+
+def _extend_trajectory(t_l, traj, dist, l, predecessors, data, s, voting_scheme, branch,
+	n_jobs, space, evec0=None, advance=None):
+	""" Extend the landmark positions of a subsample run to all cells. Positions start as
+	the landmark weighted averages of t_l and are refined by full realignment passes.
+	:param t_l: Trajectory positions of the landmarks
+	:param advance: Called with 1 after every pass, see Instrumentation.counter
+	:return: Trajectory (not normalized), the previous iterate the perspectives were
+	realigned to, realigned perspectives and the branch eigenvector
+	"""
+	W_full = _weighting_scheme(voting_scheme, dist, space)
+	t = np.empty(dist.shape[1], dtype=dist.dtype)
+	for b in space.blocks(*dist.shape):
+		t[b] = np.dot(t_l, W_full[:, b])
+	t[l] = t_l
+
+	evec2, W_muted = evec0, None
+	sigma = _affinity_sigma(dist, space) if branch else None
+	for i in range(_EXTENSION_PASSES):
+		t_prev = t
+		traj = _realign_trajectory([t_prev], dist, l, traj, 0, len(dist), 1, n_jobs, space)
+		W = W_full
 		if branch:
-			# Recalculate branches post reassignments
-			RNK, bp, diffdists, Y = _splittobranches(traj, traj[0], data, iter_l, dist,paths_l2l)
-			branches.append(RNK)
-			bas.append(Y)
-
-			# Set return values
-			branches = branches[0]
-			bas = bas[0]
-		else:
-			branches = None
-			bas = None
-
-		trajectory = trajectory[0]
-		waypoints = waypoints[0]
-		return dict(zip(['Trajectory', 'Waypoints', 'Branches', 'BAS'],
-		  [trajectory, waypoints, branches, bas]))
-
-
+			RNK, bp, diffdists, Y, evec2 = _splittobranches(traj, traj[0], data, l, dist, predecessors, space, evec2, None, sigma)
+			W = W_muted = _muteCrossBranchVoting(W_full, RNK, RNK[s], l, Y, space, W_muted)
+		t = _weighted_trajectory(traj, W, space)
+		if advance is not None:
+			advance(1)
+	return t, t_prev, traj, evec2
+
+
+def _neighbor_index(nn_backend, n_neighbors, metric, n_jobs, random_state):
+	""" Unfitted nearest neighbor index for the lNN graph and waypoint flocking
+	:param nn_backend: 'exact' (sklearn NearestNeighbors), 'approximate'
+	(wishbone.neighbors.ApproximateNeighbors, euclidean only) or an object with the
+	fit and kneighbors methods of sklearn.neighbors.NearestNeighbors
+	"""
+	if nn_backend == 'exact':
+		return NearestNeighbors(n_neighbors=n_neighbors, metric=metric, n_jobs=n_jobs)
+	if nn_backend == 'approximate':
+		if metric not in ('euclidean', 'minkowski'):
+			raise ValueError('The approximate neighbor backend only supports euclidean distances')
+		return ApproximateNeighbors(n_neighbors=n_neighbors, random_state=random_state)
+	if not (hasattr(nn_backend, 'fit') and hasattr(nn_backend, 'kneighbors')):
+		raise ValueError('nn_backend must be \'exact\', \'approximate\' or provide fit and kneighbors')
+	return nn_backend
+
+
+def _knn_graph(nbrs, data, n_neighbors):
+	# sparse cells x cells distance graph, each row holding the neighbors of a cell
+	distances, indices = nbrs.kneighbors(data, n_neighbors=n_neighbors)
+	return sparse.csr_matrix((np.ravel(distances), np.ravel(indices),
+		np.arange(0, indices.size + 1, n_neighbors)), shape=(len(data), len(data)))
+
+
+def _lnn_graph(data, k, l, metric, n_jobs, random_state, nn_backend, cache):
+	""" Fit the neighbor index and build the directed lNN graph, reusing them from the
+	cache when they are deterministic
+	:return: Fitted index, lNN graph (column i holds the neighbors of cell i) and the
+	cache key of the undirected klNN graph (None if it can not be cached)
+	"""
+	if nn_backend == 'approximate' and data.shape[1] < _APPROXIMATE_DIMS[0]:
+		warnings.warn('Exact neighbor search is used for the %d dimensional data, the approximate '
+			'backend is only faster from %d dimensions' % (data.shape[1], _APPROXIMATE_DIMS[0]))
+		nn_backend = 'exact'
+	elif nn_backend == 'approximate' and data.shape[1] > _APPROXIMATE_DIMS[1]:
+		warnings.warn('The approximate neighbor backend misses many neighbors beyond %d dimensions, '
+			'consider nn_backend=\'exact\' or fewer components' % _APPROXIMATE_DIMS[1])
+
+	lnn_key = None
+	if cache is not None and (nn_backend == 'exact' or (nn_backend == 'approximate'
+		and isinstance(random_state, numbers.Integral))):
+		lnn_key = GraphCache.key('lnn', data, l, metric, nn_backend, random_state)
+	cached = cache.get(lnn_key) if lnn_key is not None else None
+	if cached is not None:
+		nbrs, lnn = cached
+	else:
+		nbrs = _neighbor_index(nn_backend, l+1, metric, n_jobs, random_state).fit(data)
+		lnn = _knn_graph(nbrs, data, l+1)
+		lnn = np.transpose(lnn).astype(data.dtype)
+		if lnn_key is not None:
+			cache.put(lnn_key, (nbrs, lnn), 2 * data.nbytes + _nbytes(lnn))
+	graph_key = GraphCache.key('klnn', lnn_key, k) if lnn_key is not None and k == l else None
+	return nbrs, lnn, graph_key
+
+
+class GraphCache:
+	""" Cache of the graphs and landmark shortest path rows computed by wishbone, to be
+	shared by repeated runs on the same data. Entries are keyed by a content hash of
+	the data and the graph parameters; the least recently used entries are evicted
+	once the cached arrays exceed max_bytes.
+	"""
+
+	def __init__(self, max_bytes=2**30):
+		"""
+		:param max_bytes: Budget for the cached arrays in bytes
+		"""
+		self.max_bytes = max_bytes
+		self.nbytes = 0
+		self._entries = OrderedDict()
+		self._lock = threading.Lock()
+
+	def __len__(self):
+		return len(self._entries)
+
+	@staticmethod
+	def key(*parts):
+		""" Content hash of arrays and parameters """
+		digest = hashlib.sha1()
+		for part in parts:
+			if isinstance(part, np.ndarray):
+				digest.update(str((part.shape, part.dtype.str)).encode())
+				digest.update(np.ascontiguousarray(part).tobytes())
+			else:
+				digest.update(repr(part).encode())
+		return digest.hexdigest()
+
+	def get(self, key):
+		with self._lock:
+			if key not in self._entries:
+				return None
+			self._entries.move_to_end(key)
+			return self._entries[key][0]
+
+	def put(self, key, value, nbytes):
+		with self._lock:
+			if key in self._entries or nbytes > self.max_bytes:
+				return
+			self._entries[key] = (value, nbytes)
+			self.nbytes += nbytes
+			while self.nbytes > self.max_bytes:
+				_, (_, evicted) = self._entries.popitem(last=False)
+				self.nbytes -= evicted
+
+	def clear(self):
+		with self._lock:
+			self._entries.clear()
+			self.nbytes = 0
+
+
+def _nbytes(matrix):
+	# memory held by a dense or sparse matrix
+	if sparse.issparse(matrix):
+		return matrix.data.nbytes + matrix.indices.nbytes + matrix.indptr.nbytes
+	return matrix.nbytes
+
+
+def _consensus(results, branch):
+	""" Combine the trajectories and branches of several klNN graphs
+	:param results: List of (trajectory, waypoints, branches, bas, landmarks) per graph
+	:param branch: Whether branches were computed
+	:return: Mean trajectory, waypoints of the first graph, majority vote branches
+	and mean BAS
+	"""
+	if len(results) == 1:
+		return results[0][:4]
+
+	# cells dropped from the connected component of the start cell in some graphs
+	# are averaged over the remaining ones
+	with warnings.catch_warnings():
+		warnings.simplefilter('ignore', RuntimeWarning)
+		trajectory = np.nanmean([res[0] for res in results], axis=0)
+	waypoints = results[0][1]
+	if not branch:
+		return trajectory, waypoints, None, None
+
+	# Branch ids 2 and 3 follow the arbitrary sign of the eigenvector in each
+	# graph, align every graph to the first one before voting
+	reference = results[0][2]
+	branches, bas = [], []
+	for _, _, RNK, Y, _ in results:
+		swapped = np.choose(np.asarray(RNK, dtype=int), [0, 1, 3, 2])
+		if np.sum(swapped == reference) > np.sum(RNK == reference):
+			RNK, Y = swapped, -Y
+		branches.append(RNK)
+		bas.append(Y)
+
+	# Majority vote, ties go to the trunk, cells dropped in all graphs stay 0
+	labels = np.array([1, 2, 3])
+	votes = np.array([np.sum(np.array(branches) == label, axis=0) for label in labels])
+	branches = labels[np.argmax(votes, axis=0)].astype(float)
+	branches[votes.sum(axis=0) == 0] = 0
+	with warnings.catch_warnings():
+		warnings.simplefilter('ignore', RuntimeWarning)
+		bas = np.nanmean(bas, axis=0)
+	return trajectory, waypoints, branches, bas
 
 
 
+# All the utility functions
+#randomly removing l-k edges for each iteration of graph_num
+def _spdists_klnn(spdists, k, verbose, random_state=None):
+    random_state = check_random_state(random_state)
 
+    # Work on the CSC structure so that each column's edges are contiguous
+    spdists = sparse.csc_matrix(spdists, copy=True)
+    spdists.eliminate_zeros()
 
+    # Rank the edges of every column in a random order and keep the first k
+    n_edges = np.diff(spdists.indptr)
+    columns = np.repeat(np.arange(spdists.shape[1]), n_edges)
+    order = np.lexsort((random_state.random_sample(spdists.nnz), columns))
+    rank = np.empty(spdists.nnz, dtype=np.intp)
+    rank[order] = np.arange(spdists.nnz) - spdists.indptr[columns]
+    spdists.data[rank >= k] = 0
+    spdists.eliminate_zeros()
 
-
-# All the utility functions
-#randomly removing l-k edges for each iteration of graph_num
-def _spdists_klnn(spdists,k,verbose):
-    
-    #TODO - avoid converting back to non-sparse
-    if sparse.issparse(spdists):
-        spdists = spdists.toarray()
-
-    for idx in range(len(spdists)):
-        neighs = np.where(spdists[:,idx] != 0)[0]
-        l = len(neighs)
-        remove_indices = neighs[np.random.choice(l,l-k,replace=False)]
-        spdists[remove_indices,idx] = 0
-    
-    return sparse.csr_matrix(spdists)
+    return spdists.tocsr()
 
 #making graph undirected
 def _spdists_undirected(spdists):
@@ -157,121 +787,416 @@ def _spdists_undirected(spdists):
 	return spdists
 
 #calculated weighting matrix
-def _weighting_scheme(voting_scheme, dist):
-    if voting_scheme == 'uniform':
-        W_full = np.ones(dist.shape())
-    elif voting_scheme == 'exponential':
-        dist_transposed = dist.transpose()
-        std = np.empty(len(dist_transposed))
-        for i in range(len(dist_transposed)):
-            std[i] = np.std(dist_transposed[i])
-        sdv = np.mean (std)*3
-        W_full = np.exp( -.5 * np.power((dist / sdv), 2))
-    elif voting_scheme == 'linear':
-        W_full = matlib.repmat(dist.max(), len(dist), 1) - dist
+def _weighting_scheme(voting_scheme, dist, space=None):
+    """ Column stochastic landmark weights of every cell, computed in place one block of
+    cells at a time. Only depends on dist, so it is computed once per refinement.
+    :param voting_scheme: 'uniform', 'exponential' or 'linear'
+    :param dist: L x N landmark distances
+    :return: L x N weights
+    """
+    space = space if space is not None else _Workspace()
+    blocks = space.blocks(*dist.shape)
+    scale = _voting_scale(voting_scheme, dist, blocks)
+
+    W_full = space.empty(dist.shape, dist.dtype)
+    for b in blocks:
+        _voting_weights(voting_scheme, dist[:, b], scale, W_full[:, b])
+    return W_full
 
-    # The weighing matrix must be a column stochastic operator
-    W_full_transposed = W_full.transpose()
-    W_full_sum = np.empty(len(W_full_transposed))
-    for i in range(len(W_full_transposed)):
-        W_full_sum[i] = W_full_transposed[i].sum()
 
-    W_full = np.divide(W_full, matlib.repmat( W_full_sum, len( W_full), 1 ))
-    return W_full
+def _voting_scale(voting_scheme, dist, blocks):
+    # width of the exponential or largest distance of the linear voting scheme
+    if voting_scheme == 'exponential':
+        std = np.concatenate([np.std(dist[:, b], axis=0) for b in blocks])
+        return dist.dtype.type(np.mean(std)*3)
+    elif voting_scheme == 'linear':
+        return dist.max()
+    elif voting_scheme != 'uniform':
+        raise ValueError('voting_scheme must be \'uniform\', \'exponential\' or \'linear\'')
 
 
-def _realign_trajectory(t, dist, l, traj, start_range, end_range, realign_iter):
-    for idx in range(start_range, end_range):
-        #find position of landmark in previous iteration
-        idx_val = t[realign_iter - 1][l[idx]]
-        #convert all cells before starting point to the negative
-        before_indices = np.where(t[realign_iter - 1] < idx_val)[0]
-        for before_idx in before_indices:
-            traj[idx][before_idx] = -dist[idx][before_idx]
+def _voting_weights(voting_scheme, dist, scale, out):
+    # column stochastic weights of a block of cells, written to out
+    if voting_scheme == 'uniform':
+        out[:] = dist.dtype.type(1) / len(dist)
+        return out
+    if voting_scheme == 'exponential':
+        np.divide(dist, scale, out=out)
+        np.square(out, out=out)
+        np.multiply(out, -.5, out=out)
+        np.exp(out, out=out)
+    else:
+        np.subtract(scale, dist, out=out)
+
+    # The weighing matrix must be a column stochastic operator
+    out /= out.sum(axis=0)
+    return out
+
+
+def _realign_trajectory(t, dist, l, traj, start_range, end_range, realign_iter, n_jobs=1, space=None):
+    #position of all cells and landmarks in previous iteration
+    t_prev = t[realign_iter - 1]
+    l = np.asarray(l)
+
+    def realign_rows(rows):
+        idx_val = t_prev[l[rows]]
+        #convert all cells before each landmark's starting point to the negative.
+        #every chunk has its own mask, chunks may be realigned concurrently
+        before = space.scratch(('before', rows.start), traj[rows].shape, bool)
+        np.less(t_prev[np.newaxis, :], idx_val[:, np.newaxis], out=before)
+        np.copyto(traj[rows], dist[rows])
+        np.negative(dist[rows], out=traj[rows], where=before)
         #set zero to position of starting point
-        traj[idx] = traj[idx] + idx_val
+        traj[rows] += idx_val[:, np.newaxis]
 
-    traj = np.subtract(traj, np.min(traj))
+    # Landmark perspectives are independent, realign them in parallel
+    space = space if space is not None else _Workspace()
+    _map_row_chunks(realign_rows, np.arange(start_range, end_range), n_jobs,
+        space.max_rows(dist.shape[1]))
+
+    traj -= np.min(traj)
     return traj
 
 
+def _realign_incremental(t_prev, dist, l, traj, positions, shift, tol, space=None):
+    """ Realign only the perspectives of landmarks that moved by more than tol since
+    they were last realigned, the others are reused as is
+    :param t_prev: Trajectory of the previous iteration
+    :param positions: Landmark positions each perspective is aligned to (None to realign all)
+    :param shift: Offset subtracted from the perspectives so that traj is non-negative
+    :param tol: Tolerance as a fraction of the range of t_prev, which is in shortest path
+    distance units
+    :param space: _Workspace providing the scratch buffer of the realignment
+    :return: Updated positions and shift
+    """
+    space = space if space is not None else _Workspace()
+    new_positions = t_prev[l]
+    if positions is None:
+        positions = np.copy(new_positions)
+        moved = np.arange(len(l))
+    else:
+        moved = np.where(np.absolute(new_positions - positions) > tol * np.ptp(t_prev))[0]
+
+    before = space.scratch('before', dist.shape[1], bool)
+    for row in moved:
+        idx_val = new_positions[row]
+        np.less(t_prev, idx_val, out=before)
+        np.copyto(traj[row], dist[row])
+        np.negative(dist[row], out=traj[row], where=before)
+        traj[row] += idx_val - shift
+        positions[row] = idx_val
+
+    delta = np.min(traj)
+    traj -= delta
+    return positions, shift + delta
+
+
+# Mixing parameters of the accelerated realignment schemes
+_DAMPING = 0.5
+_ANDERSON_DEPTH = 3
+
+# Full realignment passes extending a landmark subsample run to all cells
+_EXTENSION_PASSES = 2
+
+# Data dimensions for which the approximate neighbor backend is faster than exact search
+# with good recall, see wishbone.neighbors.ApproximateNeighbors
+_APPROXIMATE_DIMS = (8, 20)
+
+# Landmarks solved between progress updates and cancellation checks
+_PROGRESS_ROWS = 16
+
+# Waypoint selection strategies of _select_waypoints
+_WAYPOINT_STRATEGIES = ('random', 'farthest', 'density')
+
+
+def _anderson_mixing(inputs, outputs):
+    """ Anderson mixing of the trajectory fixed-point iteration
+    :param inputs: Recent trajectories fed to the realignment, oldest first
+    :param outputs: Weighted trajectories they produced, oldest first
+    :return: Next trajectory
+    """
+    residuals = np.subtract(outputs, inputs)
+    if len(residuals) < 2:
+        return outputs[-1]
+    dF = np.diff(residuals, axis=0).T
+    dG = np.diff(outputs, axis=0).T
+    gamma = linalg.lstsq(dF, residuals[-1], rcond=None)[0]
+    return outputs[-1] - np.dot(dG, gamma)
+
+
+def _effective_n_jobs(n_jobs):
+    # None means 1 and negative values count back from the number of cores,
+    # -1 using all of them
+    if n_jobs is None:
+        return 1
+    if n_jobs < 0:
+        n_jobs = (os.cpu_count() or 1) + 1 + n_jobs
+    return max(1, int(n_jobs))
+
+
+def _instrumentation(instrument, progress=None, cancel=None):
+    """ Instrumentation of a run from the instrument, progress and cancel arguments of wishbone
+    :param instrument: None, a callable receiving every stage event, the path of a JSON
+    run report or an Instrumentation
+    :param progress: None or a callable receiving the progress updates of the stages
+    :param cancel: None or a CancelToken stopping the run
+    :return: Instrumentation
+    """
+    if instrument is None:
+        instrument = Instrumentation()
+    elif isinstance(instrument, str):
+        instrument = Instrumentation(report=instrument)
+    elif callable(instrument):
+        instrument = Instrumentation(callback=instrument)
+    elif not isinstance(instrument, Instrumentation):
+        raise ValueError('instrument must be None, a callable, a report path or an Instrumentation')
+    if progress is not None or cancel is not None:
+        instrument = instrument.bind()
+        instrument.progress = progress if progress is not None else instrument.progress
+        instrument.cancel = cancel if cancel is not None else instrument.cancel
+    return instrument
+
+
+def _map_row_chunks(func, rows, n_jobs, max_rows=None):
+    """ Apply func to contiguous chunks of rows in a thread pool. Workers share all
+    arrays with the caller and write disjoint rows, so results do not depend on
+    the number of workers.
+    :param func: Function taking a slice of rows, so that it can work on views
+    :param rows: Consecutive row indices to process
+    :param n_jobs: Number of worker threads
+    :param max_rows: Maximum number of rows per chunk (None for no limit)
+    """
+    n_jobs = _effective_n_jobs(n_jobs)
+    n_chunks = max(1, min(n_jobs, len(rows)))
+    if max_rows is not None:
+        n_chunks = max(n_chunks, int(np.ceil(len(rows) / max_rows)))
+    chunks = [slice(chunk[0], chunk[-1] + 1) for chunk in
+        np.array_split(rows, n_chunks) if len(chunk) > 0]
+    if len(chunks) <= 1 or n_jobs == 1:
+        for chunk in chunks:
+            func(chunk)
+        return
+    with ThreadPoolExecutor(max_workers=min(n_jobs, len(chunks))) as executor:
+        list(executor.map(func, chunks))
+
+
+class _Workspace:
+    """ Allocates the L x N matrices of a run and the blocks they are processed in.
+    Without a memory limit all matrices live in memory and are processed in one block.
+    With a limit, half of it is available to resident matrices, further matrices are
+    backed by numpy.memmap scratch files in the temporary directory, and the other
+    half bounds the temporaries created while processing one block.
+    """
+
+    # Number of block sized temporaries alive at once in the blocked computations
+    _temporaries = 4
+
+    def __init__(self, memory_limit=None):
+        self.memory_limit = memory_limit
+        self.resident = 0
+        self._scratch_files = []
+        self._buffers = {}
+
+    def scratch(self, name, shape, dtype=np.float64):
+        # block sized temporary reused by every request for name, e.g. once per
+        # iteration. Its contents are undefined and it is valid until the next request
+        n = int(np.prod(shape))
+        dtype = np.dtype(dtype)
+        buf = self._buffers.get(name)
+        if buf is None or buf.dtype != dtype or buf.size < n:
+            buf = self._buffers[name] = np.empty(n, dtype=dtype)
+        return buf[:n].reshape(shape)
+
+    def empty(self, shape, dtype=np.float64):
+        nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        if self.memory_limit is None or self.resident + nbytes <= self.memory_limit / 2:
+            self.resident += nbytes
+            return np.empty(shape, dtype=dtype)
+        scratch = tempfile.TemporaryFile(prefix='wishbone_')
+        self._scratch_files.append(scratch)
+        return np.memmap(scratch, dtype=dtype, mode='w+', shape=shape)
+
+    def max_rows(self, n_cols, itemsize=8):
+        # rows of n_cols entries that can be processed at once (None for no limit)
+        if self.memory_limit is None:
+            return None
+        return max(1, int(self.memory_limit / 2 / (self._temporaries * n_cols * itemsize)))
+
+    def blocks(self, n_rows, n_cols):
+        # column (cell) blocks of a n_rows x n_cols matrix
+        size = self.max_rows(n_rows)
+        if size is None or size >= n_cols:
+            return [slice(None)]
+        return [slice(start, min(start + size, n_cols)) for start in range(0, n_cols, size)]
+
+    def close(self):
+        for scratch in self._scratch_files:
+            scratch.close()
+        self._scratch_files = []
+        self._buffers = {}
+
+
+def _weighted_trajectory(traj, W, space=None):
+    # trajectory as the weighted sum of all landmark perspectives
+    space = space if space is not None else _Workspace()
+    t = np.empty(traj.shape[1], dtype=np.result_type(traj, W))
+    for b in space.blocks(*traj.shape):
+        votes = traj[:, b]
+        votes = np.multiply(votes, W[:, b], out=space.scratch('votes', votes.shape, t.dtype))
+        np.sum(votes, axis=0, out=t[b])
+    return t
+
+
 #determining initial trajectory
 def _trajectory_landmarks(spdists, data, s, waypoints, partial_order, 
-    verbose, metric, flock_waypoints, band_sample, branch):
+    verbose, metric, flock_waypoints, band_sample, branch, n_jobs=1, random_state=None,
+    space=None, nbrs=None, cache=None, graph_key=None, waypoint_strategy='random',
+    connected=False, instrument=None, processes=None):
     
     #if given a list of possible starting points, choose one
 	if verbose:
 		print('Determining waypoints if not specified...')
 	start = time.process_time()
+	space = space if space is not None else _Workspace()
+	instrument = instrument if instrument is not None else Instrumentation()
+	with instrument.stage('waypoints'):
+		s, waypoints = _select_waypoints(spdists, data, s, waypoints, partial_order, metric,
+			flock_waypoints, band_sample, waypoint_strategy, branch, n_jobs, random_state,
+			nbrs, cache, graph_key, instrument)
 
-	if len(s) > 1:
-		s = np.random.choice(s,1,replace=False)
+	if s not in partial_order:
+		partial_order = np.append(s,partial_order) #partial_order includes start point
+
+	l = np.append(partial_order,waypoints) #add extra landmarks if user specified
+	l = l.astype(int)
+
+	# # calculate all shortest paths
+	print('Determining shortest path distances and perspectives....')
+	with instrument.stage('shortest_paths'):
+		dist, predecessors = _landmark_shortest_paths(spdists, l, n_jobs, space, cache, graph_key,
+			patch_unreachable=not connected, instrument=instrument, processes=processes)
+	with instrument.stage('perspectives'):
+		traj = _landmark_perspectives(dist, l, partial_order, n_jobs, space)
 
-	#if not given landmarks list, decide on random landmarks
-	dijkstra_dist_matrix = dijkstra(spdists, directed=False, indices=s)
-	if isinstance(waypoints, int):
+	print('Time for determining distances and perspectives: %.2f seconds' % (time.process_time()-start))
+
+	return traj, dist, l, predecessors
+
+
+
+def _select_waypoints(spdists, data, s, waypoints, partial_order, metric,
+	flock_waypoints, band_sample, waypoint_strategy='random', branch=True, n_jobs=1,
+	random_state=None, nbrs=None, cache=None, graph_key=None, instrument=None):
+	""" Choose the start cell and the waypoints, flocked towards dense regions
+	:param waypoint_strategy: How waypoints are chosen if not given:
+	'random' - uniformly at random, with a share replaced by cells far from the start if branch
+	'farthest' - farthest point sampling over shortest path distances, covering the graph evenly
+	'density' - one random cell from each of the strata of equal cell counts along the
+	shortest path distance from the start, covering the trajectory at the cell density
+	:param instrument: Instrumentation reporting the progress of farthest point sampling
+	:return: Start cell (as a length one array) and list of waypoints
+	"""
+	random_state = check_random_state(random_state)
+	instrument = instrument if instrument is not None else Instrumentation()
+
+	if len(s) > 1:
+		s = random_state.choice(s,1,replace=False)
+
+	#if not given landmarks list, decide on landmarks
+	dijkstra_dist_matrix = _landmark_shortest_paths(spdists, np.asarray(s), 1, None,
+		cache, graph_key, patch_unreachable=False)[0][0]
+	reachable = np.isfinite(dijkstra_dist_matrix)
+	if isinstance(waypoints, int) and waypoint_strategy == 'farthest':
+		waypoints = _farthest_waypoints(spdists, dijkstra_dist_matrix, partial_order,
+			waypoints-1-len(partial_order), instrument.counter('waypoints', waypoints-1-len(partial_order)))
+	elif isinstance(waypoints, int) and waypoint_strategy == 'density':
+		waypoints = _stratified_waypoints(dijkstra_dist_matrix, waypoints-1-len(partial_order),
+			random_state)
+	elif isinstance(waypoints, int):
 		n_opts = np.arange(0, len(data))
 		if band_sample:
 			n_opts = []
 			window_size = 0.1
-			max_dist = dijkstra_dist_matrix.max()
+			max_dist = dijkstra_dist_matrix[reachable].max()
 			prc = 0.998
 			while prc > 0.08:
-				band = [i for i in range(len(dijkstra_dist_matrix)) if dijkstra_dist_matrix[i]>= ((prc-window_size)*max_dist) and dijkstra_dist_matrix[i]<=prc*max_dist]
-				n_opts = np.append(n_opts, np.random.choice( band, min(len(band), waypoints[0] - 1 - len(partial_order)), replace=False ))
+				band = np.where((dijkstra_dist_matrix >= (prc-window_size)*max_dist) & (dijkstra_dist_matrix <= prc*max_dist))[0]
+				n_opts = np.append(n_opts, random_state.choice( band, min(len(band), waypoints - 1 - len(partial_order)), replace=False ))
 				prc = prc - window_size
 
-		waypoints = np.random.choice(n_opts, waypoints-1-len(partial_order), replace=False)
+		waypoints = random_state.choice(n_opts, waypoints-1-len(partial_order), replace=False)
 		waypoints = [int(waypoints[i]) for i in range(len(waypoints))]
 
 		if branch:
 			tailk=30
-			tailband = np.where(dijkstra_dist_matrix>=np.percentile(dijkstra_dist_matrix, 85))[0]
+			tailband = np.where(reachable & (dijkstra_dist_matrix>=np.percentile(dijkstra_dist_matrix[reachable], 85)))[0]
 			tailk = int(min(len(tailband), tailk, np.floor(len(waypoints)/2)))
-			to_replace = np.random.randint(len(waypoints)-1, size=tailk)
-			tailband_sample = np.random.choice( tailband, size=tailk, replace=False)
+			to_replace = random_state.randint(len(waypoints)-1, size=tailk)
+			tailband_sample = random_state.choice( tailband, size=tailk, replace=False)
 			for i in range(len(to_replace)):
-				waypoints[to_replace[i]] = tailband_sample[i]
+				waypoints[to_replace[i]] = int(tailband_sample[i])
 
 	# Flock wayoints
-	if flock_waypoints:
-		nbrs = NearestNeighbors(n_neighbors=20, metric=metric).fit(data) 
+	if flock_waypoints and nbrs is None:
+		nbrs = NearestNeighbors(n_neighbors=20, metric=metric, n_jobs=n_jobs).fit(data)
 	for f in range(flock_waypoints):
-		IDX = nbrs.kneighbors([data[i] for i in waypoints], return_distance=False)
-		for i in range(len(waypoints)): 
-			med_data = np.median(data[IDX[i,:],:],axis=0)
-			waypoints[i] = nbrs.kneighbors(med_data.reshape(1, -1), n_neighbors=1, return_distance=False)[0][0]
-
-
-	if s not in partial_order:
-		partial_order = np.append(s,partial_order) #partial_order includes start point
-
-	l = np.append(partial_order,waypoints) #add extra landmarks if user specified
-	l = l.astype(int)
-
-	# # calculate all shortest paths
-	print('Determining shortest path distances and perspectives....')
-	graph = nx.Graph(spdists)
-	dist = np.zeros([len(l), data.shape[0]])
-	paths_l2l = list()
-
-	for i in range(len(l)):
-		# Shortest distances and paths
-		temp = nx.single_source_dijkstra(graph, l[i])
-		paths = temp[1]
-		dist[i, list(temp[0].keys())] = list(temp[0].values())
-		paths_l2l.append( [paths[li] for li in l] )
-
-		# Update distances for unreachable cells
-		unreachable = np.where(dist[i, :]==np.inf)[0]
-		if(len(unreachable) > 0):
-			dist[i, unreachable] = np.max(dist[i, dist[i, :] != np.inf])
-		if(verbose):
-			sys.stdout.write('.')
-	print("")
+		# move every waypoint to the cell closest to the median of its neighborhood
+		IDX = nbrs.kneighbors(data[waypoints], n_neighbors=20, return_distance=False)
+		med_data = np.median(data[IDX], axis=1)
+		waypoints = [int(i) for i in nbrs.kneighbors(med_data, n_neighbors=1, return_distance=False)[:, 0]]
+
+	return s, waypoints
+
+
+def _farthest_waypoints(spdists, s_dist, partial_order, n_waypoints, advance=None):
+	""" Farthest point sampling: every waypoint is the cell farthest from the start cell,
+	the partial order landmarks and the waypoints chosen before it. Cells unreachable
+	from the start cell are never chosen.
+	:param s_dist: Shortest path distances from the start cell
+	:param advance: Called with 1 after every waypoint, see Instrumentation.counter
+	:return: List of waypoints
+	"""
+	graph = sparse.csr_matrix(spdists, dtype=np.float64)
+	min_dist = np.where(np.isfinite(s_dist), s_dist, -np.inf)
+	if len(partial_order) > 0:
+		po_dist = dijkstra(graph, directed=False, indices=np.asarray(partial_order, dtype=int))
+		np.minimum(min_dist, po_dist.min(axis=0), out=min_dist)
 
+	waypoints = []
+	for i in range(n_waypoints):
+		farthest = int(np.argmax(min_dist))
+		if min_dist[farthest] <= 0:
+			raise RuntimeError('Fewer cells are reachable from the start cell than waypoints requested')
+		waypoints.append(farthest)
+		# only cells closer to the new waypoint than the current maximum can change
+		np.minimum(min_dist, dijkstra(graph, directed=False, indices=farthest,
+			limit=min_dist[farthest]), out=min_dist)
+		if advance is not None:
+			advance(1)
+	return waypoints
+
+
+def _stratified_waypoints(s_dist, n_waypoints, random_state):
+	""" One random waypoint from each of n_waypoints strata of equal size, ordering the
+	cells reachable from the start cell by their shortest path distance to it
+	:param s_dist: Shortest path distances from the start cell
+	:return: List of waypoints
+	"""
+	reachable = np.where(np.isfinite(s_dist))[0]
+	if n_waypoints > len(reachable):
+		raise RuntimeError('Fewer cells are reachable from the start cell than waypoints requested')
+	order = reachable[np.argsort(s_dist[reachable], kind='stable')]
+	return [int(random_state.choice(stratum)) for stratum in np.array_split(order, n_waypoints)]
+
+
+def _landmark_perspectives(dist, l, partial_order, n_jobs=1, space=None):
+	""" Initial perspective of every landmark, aligned to the start cell
+	:param dist: L x N landmark distances, adjusted in place for the partial order
+	:param partial_order: Start cell followed by user specified ordered landmarks
+	:return: L x N perspectives
+	"""
+	space = space if space is not None else _Workspace()
 	#adjust paths according to partial order by redirecting
-	dist = np.array(dist)
 	nPartialOrder = len(partial_order)   
 	for radius in range(1,nPartialOrder+1): 
 		for landmark_row in range(1,nPartialOrder+1):
@@ -287,38 +1212,190 @@ def _trajectory_landmarks(spdists, data, s, waypoints, partial_order,
 				dist[a-1][partial_order[c-1]] = dist[a-1][partial_order[b-1]] + dist[b-1][partial_order[c-1]]
 
 	#align to dist_1
-	traj = np.empty_like (dist)
+	traj = space.empty(dist.shape, dist.dtype)
 	np.copyto(traj,dist)
 
 	for idx in range(1,len(partial_order)):
-		closest_landmark_row = argmin(dist,axis=0) #closest landmark will determine directionality
+		closest_landmark_row = np.argmin(dist,axis=0) #closest landmark will determine directionality
 		traj[idx, closest_landmark_row < idx] = -dist[idx][closest_landmark_row < idx]
 		traj[ idx, : ] = traj[ idx, : ] + dist[0][l[idx]]
 
 
 	if len(l) > len(partial_order):
-		traj = _realign_trajectory(dist, dist, l, traj, len(partial_order), len(l), 1)
-
-	print('Time for determining distances and perspectives: %.2f seconds' % (time.process_time()-start))
+		traj = _realign_trajectory(dist, dist, l, traj, len(partial_order), len(l), 1, n_jobs, space)
+
+	return traj
+
+
+def _shared_array(shape, dtype):
+	# array in a new shared memory block, and the specification attaching to it
+	dtype = np.dtype(dtype)
+	block = shared_memory.SharedMemory(create=True,
+		size=max(1, int(np.prod(shape)) * dtype.itemsize))
+	return block, np.ndarray(shape, dtype, buffer=block.buf), (block.name, shape, dtype.str)
+
+
+def _attach_shared_array(spec):
+	name, shape, dtype = spec
+	block = shared_memory.SharedMemory(name=name)
+	return block, np.ndarray(shape, dtype, buffer=block.buf)
+
+
+# Graph and output slots of a shortest path worker process
+_shortest_path_worker = {}
+
+
+def _init_shortest_path_worker(graph_specs, shape, slot_specs):
+	blocks, (data, indices, indptr) = zip(*[_attach_shared_array(spec) for spec in graph_specs])
+	slot_blocks, slots = zip(*[_attach_shared_array(spec) for spec in slot_specs])
+	# the shared memory blocks stay attached until the process exits
+	_shortest_path_worker.update(blocks=blocks + slot_blocks, slots=slots,
+		graph=sparse.csr_matrix((data, indices, indptr), shape=shape, copy=False))
+
+
+def _solve_shortest_path_slot(slot, sources):
+	dist, predecessors = _shortest_path_worker['slots']
+	dist[slot, :len(sources)], predecessors[slot, :len(sources)] = dijkstra(
+		_shortest_path_worker['graph'], directed=False, indices=sources, return_predecessors=True)
+
+
+def _shortest_paths_in_processes(graph, l, blocks, dist, predecessors, processes, solved):
+	""" Solve blocks of landmark rows in worker processes. The graph is shared with the
+	workers through shared memory, each worker writes its rows to its own shared slot and
+	they are copied from there into dist and predecessors, which may be memory mapped.
+	:param graph: float64 CSR klNN graph
+	:param blocks: Row indices of the landmarks in l solved together
+	:param solved: Called with the rows of every block once they are in dist
+	"""
+	processes = min(processes, len(blocks))
+	shared, slot_dist, slot_predecessors = [], [], []
+	try:
+		graph_specs = []
+		for array in (graph.data, graph.indices, graph.indptr):
+			block, copy, spec = _shared_array(array.shape, array.dtype)
+			copy[...] = array
+			shared.append(block)
+			graph_specs.append(spec)
+			del copy
+		slot_shape = (processes, max(len(rows) for rows in blocks), graph.shape[0])
+		slot_specs = []
+		for dtype, views in ((np.float64, slot_dist), (np.int32, slot_predecessors)):
+			block, view, spec = _shared_array(slot_shape, dtype)
+			shared.append(block)
+			views.append(view)
+			slot_specs.append(spec)
+
+		executor = ProcessPoolExecutor(max_workers=processes, initializer=_init_shortest_path_worker,
+			initargs=(graph_specs, graph.shape, slot_specs))
+		try:
+			pending, todo = {}, iter(blocks)
+			for slot, rows in zip(range(processes), todo):
+				pending[executor.submit(_solve_shortest_path_slot, slot, l[rows])] = (slot, rows)
+			while pending:
+				finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+				for future in finished:
+					slot, rows = pending.pop(future)
+					future.result()
+					dist[rows] = slot_dist[0][slot, :len(rows)]
+					predecessors[rows] = slot_predecessors[0][slot, :len(rows)]
+					solved(rows)
+					rows = next(todo, None)
+					if rows is not None:
+						pending[executor.submit(_solve_shortest_path_slot, slot, l[rows])] = (slot, rows)
+		finally:
+			executor.shutdown(wait=True, cancel_futures=True)
+	finally:
+		# the views have to go before their blocks can be closed
+		del slot_dist[:], slot_predecessors[:]
+		for block in shared:
+			block.close()
+			block.unlink()
+
+
+def _landmark_shortest_paths(spdists, l, n_jobs=1, space=None, cache=None, graph_key=None,
+	patch_unreachable=True, instrument=None, processes=None):
+	""" Shortest path distances from every landmark to every cell
+	:param spdists: Sparse undirected klNN graph (CSR)
+	:param l: Landmark cell indices
+	:param n_jobs: Number of threads patching unreachable distances
+	:param space: _Workspace allocating the matrices
+	:param cache: GraphCache holding the rows of earlier runs on the same graph
+	:param graph_key: Cache key of spdists, None if rows are not to be cached
+	:param patch_unreachable: Replace infinite distances by the largest finite one of the row
+	:param instrument: Instrumentation reporting the progress per block of landmarks
+	:param processes: Number of worker processes solving blocks of landmarks, by default
+	n_jobs if above 1. scipy's Dijkstra holds the GIL, so threads would run one at a time.
+	With 0 the landmarks are solved in this process
+	:return: L x N distance matrix in the dtype of the graph and L x N int32
+	predecessor matrix (-9999 for the source and for unreachable cells)
+	"""
+	space = space if space is not None else _Workspace()
+	instrument = instrument if instrument is not None else Instrumentation()
+	dist = space.empty((len(l), spdists.shape[0]), spdists.dtype)
+	predecessors = space.empty((len(l), spdists.shape[0]), dtype=np.int32)
+	max_rows = space.max_rows(spdists.shape[0])
+
+	# rows of landmarks solved in earlier runs
+	missing = np.arange(len(l))
+	if cache is not None and graph_key is not None:
+		row_keys = [GraphCache.key('row', graph_key, source) for source in l]
+		rows = [cache.get(key) for key in row_keys]
+		for i, row in enumerate(rows):
+			if row is not None:
+				dist[i], predecessors[i] = row
+		missing = np.array([i for i, row in enumerate(rows) if row is None], dtype=int)
+
+	if len(missing) > 0:
+		# the solver works on float64 CSR graphs, convert once rather than per block
+		graph = sparse.csr_matrix(spdists, dtype=np.float64)
+
+		# Multi-source Dijkstra over the CSR graph, a few landmarks at a time to report
+		# progress and respond to cancellation
+		advance = instrument.counter('shortest_paths', len(missing))
+		blocks = [missing[start:start + _PROGRESS_ROWS]
+			for start in range(0, len(missing), _PROGRESS_ROWS)]
+		def solved(rows):
+			if cache is not None and graph_key is not None:
+				for i in rows:
+					cache.put(row_keys[i], (np.copy(dist[i]), np.copy(predecessors[i])),
+						dist[i].nbytes + predecessors[i].nbytes)
+			advance(len(rows))
+
+		if processes is None:
+			processes = _effective_n_jobs(n_jobs) if _effective_n_jobs(n_jobs) > 1 else 0
+		if processes > 0 and len(blocks) > 0:
+			_shortest_paths_in_processes(graph, l, blocks, dist, predecessors, processes, solved)
+		else:
+			for rows in blocks:
+				dist[rows], predecessors[rows] = dijkstra(graph, directed=False,
+					indices=l[rows], return_predecessors=True)
+				solved(rows)
 
-	return traj, dist, l, paths_l2l
+	# Update distances for unreachable cells
+	def patch(rows):
+		unreachable = np.isinf(dist[rows])
+		if unreachable.any():
+			row_max = np.where(unreachable, -np.inf, dist[rows]).max(axis=1)
+			np.copyto(dist[rows], row_max[:, np.newaxis], where=unreachable)
+	if patch_unreachable:
+		_map_row_chunks(patch, np.arange(len(l)), n_jobs, max_rows)
 
+	return dist, predecessors
 
 
-def _splittobranches(trajs, t, data, landmarks, dist, paths_l2l):
+def _splittobranches(trajs, t, data, landmarks, dist, predecessors, space=None, evec0=None, cells=None, sigma=None):
+	space = space if space is not None else _Workspace()
 
-	proposed = matlib.repmat(t[landmarks], len(trajs), 1)
-	reported = np.array([trajs[i][landmarks] for i in range(len(landmarks))])
+	# perspective of every landmark on every landmark
+	reported = np.take(trajs[:len(landmarks)], landmarks, axis=1)
 
 	#square matrix of the difference of perspectives landmark to landmark
-	diffdists = np.absolute(reported - proposed)
-	diffdists = (diffdists.T + diffdists)/2
+	diffdists = np.absolute(np.subtract(reported, t[landmarks], out=reported), out=reported)
+	diffdists = np.add(diffdists.T, diffdists)
+	diffdists /= 2
 
-	# get second eigen vector of diffdists
-	EigenVals, EigenVecs = linalg.eig(diffdists)
-	sorted_idxs = np.argsort(np.absolute(EigenVals))[::-1]
-	
-	evec2 = np.multiply(EigenVecs[:, sorted_idxs[1]], -1)
+	# get second eigen vector of diffdists, warm started from the previous iteration
+	evec2 = _second_eigenvector(diffdists, evec0)
 	idx = np.argsort(evec2)
 	evec2[np.where(evec2 == 0)[0]] = 0
 
@@ -341,34 +1418,28 @@ def _splittobranches(trajs, t, data, landmarks, dist, paths_l2l):
 	#return with current branches if branch is not found
 	if(len(c_branch) == 1):
 		print('Branch not found\n')
-		I = np.absolute(dist[:len(landmarks)][:]).min().astype(np.int)
-		RNK = c[I]
-		Y = np.zeros((len(RNK)))
-		pb = t[landmarks[(np.where(c == c_branch[0])[0][0])]]
-
-		return RNK, pb, diffdists, Y
+		return _unbranched(c, t[landmarks[(np.where(c == c_branch[0])[0][0])]], diffdists, evec2, dist, landmarks)
 
 	brancha = np.where(c == c_branch[0])[0]
 	branchb = np.where(c == c_branch[1])[0]
-	paths_branch_a = [paths_l2l[i] for i in brancha]
-	paths_branch_b = [paths_l2l[i] for i in branchb]
 	
+	# smallest trajectory value on the shortest paths between the two branches,
+	# of the cells in the subsample if the columns are one
+	path_l, path_t = landmarks, t
+	if cells is not None:
+		path_l, path_t = cells[landmarks], np.full(predecessors.shape[1], np.inf)
+		path_t[cells] = t
 	fork_p = []
-	for i in range(len(paths_branch_a)):
-		paths_branch_a_to_b = [paths_branch_a[i][k] for k in branchb]
-		for j in range(len(paths_branch_a_to_b)):
-			if paths_branch_a_to_b[j]:
-				fork_p.append(t[paths_branch_a_to_b[j]].min())
-			else:
-				print('no path from l:' + str(brancha[i]) + ' to l:' + str(branchb[j]))
-
-	for i in range(len(paths_branch_b)):
-		paths_branch_b_to_a = [paths_branch_b[i][k] for k in brancha]
-		for j in range(len(paths_branch_b_to_a)):
-			if paths_branch_b_to_a[j]:
-				fork_p.append(t[paths_branch_b_to_a[j]].min())
-			else:
-				print('no path from l:' + str(branchb[i]) + ' to l:' + str(brancha[j]))
+	for sources, targets in ((brancha, branchb), (branchb, brancha)):
+		minima = _path_minima(predecessors, path_l, sources, targets, path_t)
+		for i, j in zip(*np.where(np.isnan(minima))):
+			print('no path from l:' + str(sources[i]) + ' to l:' + str(targets[j]))
+		fork_p.append(minima[~np.isnan(minima)])
+	fork_p = np.concatenate(fork_p)
+	if len(fork_p) == 0:
+		# e.g. the branches lie in different components of a graph solved as a whole
+		print('Branch not found, no path between the branches\n')
+		return _unbranched(c, t[landmarks[brancha[0]]], diffdists, evec2, dist, landmarks)
 
 	#reassign to clusters based on branch point
 	pb = np.percentile(fork_p, 10)
@@ -392,51 +1463,169 @@ def _splittobranches(trajs, t, data, landmarks, dist, paths_l2l):
 	# 		break
 
 	c_new = c
-	I = np.argmin(np.absolute(dist[0:landmarks.size, :]), axis=0)
-	RNK = c_new[I]
 	c_new[np.where(t[landmarks].T <= pb)[0]] = c[0]
 	c_new[np.intersect1d(np.where(evec2 < 0)[0], np.where(t[landmarks].T >= pb)[0])] = c_branch[0]
 	c_new[np.intersect1d(np.where(evec2 > 0)[0], np.where(t[landmarks].T >= pb)[0])] = c_branch[1]
 
 
-	#compute affinity matrix over landmark distances
-	n = len(dist[0]) #num points
-	sigma = .1*np.std(dist, ddof=1)
-	Aff = np.exp(np.multiply(-0.5*(1/np.power(sigma, 2)), np.power(dist, 2)))
+	#compute affinity matrix over landmark distances, one block of cells at a time
+	blocks = space.blocks(*dist.shape)
+	sigma = sigma if sigma is not None else _affinity_sigma(dist, space)
+
+	#make aff matrix a stochastic operator and for each datapoint, find closest landmark
+	Y = np.empty(dist.shape[1], dtype=dist.dtype)
+	RNK = np.empty(dist.shape[1])
+	nan_rows, nan_min = np.zeros(len(dist), dtype=bool), np.inf
+	for b in blocks:
+		Stoch = _stochastic_affinity(dist[:, b], sigma, space)
+		nan_rows |= np.isnan(Stoch, out=space.scratch('nan', Stoch.shape, bool)).any(axis=1)
+		nan_min = np.fmin(nan_min, np.nanmin(Stoch))
+		Y[b] = np.multiply(np.dot(Stoch.T, evec2), np.power(t[b].T, 0.7))
+		RNK[b] = c_new[np.argmin(dist[0:landmarks.size, b], axis=0)]
+
+	# rows with undefined affinities are set to the smallest affinity of all cells
+	if nan_rows.any():
+		for b in blocks:
+			Stoch = _stochastic_affinity(dist[:, b], sigma, space)
+			Stoch[nan_rows] = nan_min
+			Y[b] = np.multiply(np.dot(Stoch.T, evec2), np.power(t[b].T, 0.7))
+	
+	return RNK, pb, diffdists, Y, evec2
+
+
+def _unbranched(c, pb, diffdists, evec2, dist, landmarks):
+	# result of _splittobranches without a branch split: cells take the cluster of their
+	# closest landmark, shortest path distances are non-negative so it has the smallest
+	I = np.argmin(dist[:len(landmarks)], axis=0)
+	RNK = c[I]
+	Y = np.zeros((len(RNK)))
+	return RNK, pb, diffdists, Y, evec2
+
+
+def _second_eigenvector(diffdists, evec0=None):
+	""" Eigenvector of the symmetric diffdists with the second largest eigenvalue magnitude
+	:param evec0: Eigenvector of the previous iteration. Used as the starting vector of the
+	partial eigensolver and to orient the result, which otherwise is oriented to have a
+	positive largest entry
+	:return: Eigenvector of unit length
+	"""
+	n = len(diffdists)
+	vals = None
+	if n > 3:
+		v0 = evec0 if evec0 is not None else np.ones(n) / np.sqrt(n)
+		try:
+			vals, vecs = eigsh(diffdists.astype(np.float64), k=2, which='LM', v0=v0)
+		except ArpackNoConvergence:
+			pass
+	if vals is None:
+		vals, vecs = linalg.eigh(diffdists)
+	evec2 = vecs[:, np.argsort(np.absolute(vals))[::-1][1]]
+
+	if evec0 is not None:
+		flip = np.dot(evec2, evec0) < 0
+	else:
+		flip = evec2[np.argmax(np.absolute(evec2))] < 0
+	return np.negative(evec2) if flip else evec2
+
+
+def _path_minima(predecessors, landmarks, sources, targets, t):
+	""" Minimum of t over the shortest paths between landmarks, walking all paths of the
+	predecessor trees back towards their source at once
+	:param predecessors: L x N predecessor matrix from _landmark_shortest_paths
+	:param sources: Rows of the source landmarks
+	:param targets: Rows of the target landmarks
+	:return: len(sources) x len(targets) minima, NaN where the target is unreachable
+	"""
+	rows = np.repeat(np.asarray(sources), len(targets))
+	origin = landmarks[rows]
+	node = np.tile(landmarks[np.asarray(targets)], len(sources))
+	minima = t[node].astype(float)
+	active = np.flatnonzero(node != origin)
+	while len(active):
+		previous = predecessors[rows[active], node[active]]
+		reachable = previous >= 0
+		active = active[reachable]
+		node[active] = previous[reachable]
+		minima[active] = np.minimum(minima[active], t[node[active]])
+		active = active[node[active] != origin[active]]
+
+	minima[node != origin] = np.nan
+	return minima.reshape(len(sources), len(targets))
+
+
+def _blocked_std(dist, blocks):
+	# standard deviation (ddof=1) of all entries, accumulated over column blocks
+	if len(blocks) == 1:
+		return np.std(dist[:, blocks[0]], ddof=1)
+	mean = sum(dist[:, b].sum() for b in blocks) / dist.size
+	ssq = sum(np.power(dist[:, b] - mean, 2).sum() for b in blocks)
+	return np.sqrt(ssq / (dist.size - 1))
+
+
+def _affinity_sigma(dist, space):
+	# bandwidth of the gaussian landmark affinities of the branch split
+	return dist.dtype.type(.1*_blocked_std(dist, space.blocks(*dist.shape)))
+
+
+def _stochastic_affinity(dist, sigma, space=None):
+	# column stochastic gaussian affinities of the cells to the landmarks, in a
+	# scratch buffer of space if given
+	out = space.scratch('affinity', dist.shape, dist.dtype) if space is not None else None
+	Aff = np.power(dist, 2, out=out)
+	np.multiply(Aff, -0.5*(1/np.power(sigma, 2)), out=Aff)
+	np.exp(Aff, out=Aff)
+	Aff /= np.sum(Aff, axis=0)
+	return Aff
+
+
+def _bas_scaling(Y, landmarks):
+	""" Scaling of the branch association scores muting the cross branch votes
+	:return: Scores scaled to the range between -1 and 1, the scaling (center and scales of
+	the negative and positive sides, see _scale_bas) and the bandwidth of the muting
+	"""
+	center = np.median(Y[landmarks])
+	Y_scale = np.subtract(Y, center)
+	indices = np.where(Y_scale < 0)[0]
+	negative = np.absolute(Y_scale[indices]).max() if len(indices) > 0 else 1
+	Y_scale[indices] = np.divide(Y_scale[indices], negative)
+	indices = np.where(Y_scale > 0)[0]
+	positive = Y_scale[indices].max() if len(indices) > 0 else 1
+	Y_scale[indices] = np.divide(Y_scale[indices], positive)
+	return Y_scale, (center, negative, positive), np.std(Y_scale, ddof=1)
 
-	#make aff matrix a stochastic operator
-	Stoch = np.divide(Aff, np.sum(Aff, axis=0))
-	Stoch[np.where(np.isnan(Stoch))[0]] = np.nanmin(Stoch)
-	Y = np.multiply(np.dot(Stoch.T, evec2), np.power(t.T, 0.7))
 
-	#for each datapoint, find closest landmark
-	I = np.argmin(np.absolute(dist[0:landmarks.size, :]), axis=0)
-	RNK = c_new[I]
-	
-	return RNK, pb, diffdists, Y 
+def _scale_bas(Y, center, negative, positive):
+	# branch association scores of other cells scaled like those of _bas_scaling
+	Y_scale = np.subtract(Y, center)
+	Y_scale[Y_scale < 0] /= negative
+	Y_scale[Y_scale > 0] /= positive
+	return Y_scale
 
 
-def _muteCrossBranchVoting(W, RNK, trunk_id, landmarks, Y):
+def _muteCrossBranchVoting(W, RNK, trunk_id, landmarks, Y, space=None, out=None):
+	# muted weights are written to out if given, e.g. those of the previous iteration
+	space = space if space is not None else _Workspace()
 	#range between -1 and 1
-	Y_scale = np.subtract(Y, np.median(Y[landmarks]))
-	indices = np.where(Y_scale < 0)[0]
-	if(len(indices) > 0):
-		Y_scale[indices] = np.divide(Y_scale[indices], np.absolute(Y_scale[indices]).max())
-	indices = np.where(Y_scale > 0)[0]
-	if(len(indices) > 0):
-		Y_scale[indices] = np.divide(Y_scale[indices], Y_scale[indices].max())
+	Y_scale, _, b = _bas_scaling(Y, landmarks)
 	Y_pos = np.absolute(Y_scale).T
 
-	W_test = W
-	b = np.std(Y_scale, ddof=1)
-
-	for i in range(Y.size):
-		crossb = np.where((np.sign(Y_scale[i]) != np.sign(Y_scale[landmarks])) == True)[0]
-		temp = np.exp(np.divide(-0.5*np.power(Y_pos[landmarks[crossb]], 2), b))
-		temp = [max(np.exp(np.divide(-0.5*np.power(Y_pos[int(i)], 2), b)), i) for i in temp]
-		
-		for j in range(len(crossb)):
-		 	W_test[crossb[j]][i] = np.multiply(W[crossb[j]][i], temp[j])
-	
-	W = np.divide(W_test, np.sum(W_test, axis=0))
-	return W
+	landmark_mute = np.exp(np.divide(-0.5*np.power(Y_pos[landmarks], 2), b))[:, np.newaxis]
+	cell_mute = np.exp(np.divide(-0.5*np.power(Y_pos, 2), b))
+	landmark_sign = np.sign(Y_scale[landmarks])[:, np.newaxis]
+	cell_sign = np.sign(Y_scale)
+
+	W_muted = out if out is not None else space.empty(W.shape, W.dtype)
+	for block in space.blocks(*W.shape):
+		W_test = W_muted[:, block]
+		shape = W_test.shape
+		# landmarks voting for cells on the other side of the branch split
+		crossb = np.not_equal(landmark_sign, cell_sign[np.newaxis, block],
+			out=space.scratch('crossb', shape, bool))
+
+		# muting factor of each vote is the larger of the landmark's and the cell's
+		mute = np.maximum(landmark_mute, cell_mute[np.newaxis, block],
+			out=space.scratch('mute', shape, np.result_type(landmark_mute, cell_mute)))
+		np.copyto(W_test, W[:, block])
+		np.multiply(W_test, mute, out=W_test, where=crossb)
+		W_test /= np.sum(W_test, axis=0)
+	return W_muted
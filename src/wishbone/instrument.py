@@ -0,0 +1,237 @@
+import copy
+import itertools
+import json
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, peak memory is then not reported
+    resource = None
+
+
+def peak_rss():
+    """ Peak resident set size of the process over its lifetime
+    :return: Bytes, None if the platform does not report it
+    """
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def current_rss():
+    """ Resident set size of the process
+    :return: Bytes, None if the platform does not report it (only Linux does)
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+# Seconds between samples of the resident memory while stages run
+_SAMPLE_INTERVAL = 0.01
+
+
+class _StagePeaks:
+    """ Peak resident memory of stages that may overlap (nested or in other threads).
+    While stages are open a background thread samples the resident memory of the process
+    and raises the peaks of all open stages, so peaks shorter than the sampling interval
+    may be missed. The high-water marks of the process (VmHWM, ru_maxrss) are left alone.
+    Needs Linux, elsewhere no peaks are reported.
+    """
+
+    def __init__(self):
+        self._open = {}
+        self._keys = itertools.count()
+        self._lock = threading.Lock()
+        self._sampler = None
+
+    def _sample(self):
+        rss = current_rss()
+        with self._lock:
+            for key in self._open:
+                self._open[key] = max(self._open[key], rss)
+
+    def _run(self):
+        while True:
+            time.sleep(_SAMPLE_INTERVAL)
+            with self._lock:
+                if not self._open:
+                    self._sampler = None
+                    return
+            self._sample()
+
+    def start(self):
+        """ :return: Key of the stage, None if peaks are not available """
+        rss = current_rss()
+        if rss is None:
+            return None
+        with self._lock:
+            key = next(self._keys)
+            self._open[key] = rss
+            if self._sampler is None:
+                self._sampler = threading.Thread(target=self._run, daemon=True)
+                self._sampler.start()
+            return key
+
+    def stop(self, key):
+        """ :return: Peak resident memory in bytes since start returned key """
+        if key is None:
+            return None
+        self._sample()
+        with self._lock:
+            return self._open.pop(key)
+
+
+_stage_peaks = _StagePeaks()
+
+
+class Cancelled(RuntimeError):
+    """ Raised inside a run whose CancelToken was cancelled or ran out of time """
+
+
+class CancelToken:
+
+    def __init__(self, timeout=None):
+        """
+        Cooperative cancellation of a run. The run checks the token in its loops and
+        stops by raising Cancelled once cancel was called, from any thread, or its time
+        budget has passed. Temporary files and worker threads of the run are cleaned up.
+        :param timeout: Time budget in seconds from the creation of the token, None for
+        no deadline
+        """
+        self.deadline = None if timeout is None else time.monotonic() + timeout
+        self._cancelled = threading.Event()
+
+    def cancel(self):
+        """ Request the run to stop at its next check
+        """
+        self._cancelled.set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set() or (
+            self.deadline is not None and time.monotonic() > self.deadline)
+
+    def check(self):
+        """ Raise Cancelled if the run is to stop
+        """
+        if self._cancelled.is_set():
+            raise Cancelled('The run was cancelled')
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            raise Cancelled('The run exceeded its time budget')
+
+
+class Instrumentation:
+
+    def __init__(self, callback=None, report=None, progress=None, cancel=None):
+        """
+        Stage events of a wishbone run. Every stage emits a dictionary with the stage name,
+        its wall_time and cpu_time in seconds, memory in bytes and the context the stage
+        ran in (e.g. graph or iteration). cpu_time covers all threads of the process,
+        including multithreaded BLAS. Memory is that of the whole process:
+        peak_rss - peak resident memory during the stage, sampled every 10 ms by a
+        background thread and only if there is a callback or report, rss_delta - resident
+        memory at its end minus at its start (both Linux only, None elsewhere), and
+        max_rss - peak resident memory of the process up to the end of the stage. Stages
+        running at the same time in other threads contribute to each other's peaks.
+        :param callback: Called with every event, from the thread that ran the stage
+        :param report: Path of a JSON run report with all events, written by save
+        :param progress: Called with a dictionary of the stage, the fraction of it done and
+        the context whenever a stage advances, e.g. per block of landmarks or per iteration
+        :param cancel: CancelToken checked at every stage and progress update
+        """
+        self.callback = callback
+        self.report = report
+        self.progress = progress
+        self.cancel = cancel
+        self.events = []
+        self.context = {}
+        self._lock = threading.Lock()
+
+    def bind(self, **context):
+        """ Instrumentation adding context to the events, sharing the events and callback
+        :return: Instrumentation
+        """
+        bound = copy.copy(self)
+        bound.context = dict(self.context, **context)
+        return bound
+
+    @contextmanager
+    def stage(self, name, **context):
+        """ Context manager timing the stage it wraps
+        :param name: Stage name
+        :param context: Additional event fields
+        """
+        self.check()
+        # peaks are only sampled if the events are consumed
+        tracked = self.callback is not None or self.report is not None
+        rss, peak_key = current_rss(), _stage_peaks.start() if tracked else None
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+            end_rss = current_rss()
+            event = dict(self.context, stage=name, wall_time=wall, cpu_time=cpu,
+                peak_rss=_stage_peaks.stop(peak_key),
+                rss_delta=None if rss is None or end_rss is None else end_rss - rss,
+                max_rss=peak_rss(), **context)
+            with self._lock:
+                self.events.append(event)
+                if self.callback is not None:
+                    self.callback(event)
+
+    def check(self):
+        """ Raise Cancelled if the run is to stop
+        """
+        if self.cancel is not None:
+            self.cancel.check()
+
+    def update(self, stage, fraction):
+        """ Report the fraction of a stage done and stop the run if it was cancelled
+        :param stage: Stage name
+        :param fraction: Fraction between 0 and 1
+        """
+        self.check()
+        if self.progress is not None:
+            with self._lock:
+                self.progress(dict(self.context, stage=stage, fraction=fraction))
+
+    def counter(self, stage, total):
+        """ Progress of a stage made of total items processed by one or more threads
+        :return: Function adding the number of items just processed
+        """
+        done = [0]
+        def advance(n_items):
+            with self._lock:
+                done[0] += n_items
+                fraction = done[0] / total if total > 0 else 1.0
+            self.update(stage, fraction)
+        return advance
+
+    def save(self):
+        """ Write the events to the JSON run report, if one was requested
+        """
+        if self.report is None:
+            return
+        with self._lock:
+            with open(self.report, 'w') as f:
+                json.dump({'events': self.events}, f, indent=1, default=_json_default)
+
+
+def _json_default(value):
+    # numpy scalars in event contexts
+    if hasattr(value, 'item'):
+        return value.item()
+    raise TypeError('%r is not JSON serializable' % value)
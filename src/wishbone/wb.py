@@ -7,7 +7,7 @@ import shlex
 import shutil
 from copy import deepcopy
 from collections import defaultdict, Counter
-from subprocess import call, Popen, PIPE
+from subprocess import call, Popen, PIPE, TimeoutExpired
 import glob
 
 import numpy as np
@@ -31,10 +31,12 @@ from numpy.linalg import norm
 from scipy.stats import gaussian_kde
 from numpy.core.umath_tests import inner1d
 from sklearn.neighbors import NearestNeighbors
+from sklearn.utils.extmath import randomized_svd
 import fcsparser
 import phenograph
 
 import wishbone
+from wishbone.instrument import Instrumentation
 
 # set plotting defaults
 with warnings.catch_warnings():
@@ -43,6 +45,12 @@ with warnings.catch_warnings():
 cmap = matplotlib.cm.Spectral_r
 size = 8
 
+# Seconds between checks for cancellation of a running GSEA process
+_GSEA_POLL_INTERVAL = 1
+
+# Power iterations of the randomized PCA
+_RANDOMIZED_PCA_ITERATIONS = 20
+
 
 def qualitative_colors(n):
     """ Generalte list of colors
@@ -98,6 +106,7 @@ class SCData:
         self._diffusion_eigenvectors = None
         self._diffusion_eigenvalues = None
         self._diffusion_map_correlations = None
+        self._diffusion_operator = None
         self._normalized = False
         self._cluster_assignments = None
 
@@ -225,6 +234,16 @@ class SCData:
                             'object')
         self._diffusion_map_correlations = item
 
+    @property
+    def diffusion_operator(self):
+        return self._diffusion_operator
+
+    @diffusion_operator.setter
+    def diffusion_operator(self, item):
+        if not (isinstance(item, dict) or item is None):
+            raise TypeError('self.diffusion_operator must be a dictionary')
+        self._diffusion_operator = item
+
     @property
     def library_sizes(self):
         return self._library_sizes
@@ -327,17 +346,36 @@ class SCData:
         return scdata
 
 
-    def run_pca(self, n_components=100):
+    def run_pca(self, n_components=100, svd_solver='full', random_state=0):
         """
         Principal component analysis of the data.
         :param n_components: Number of components to project the data
+        :param svd_solver: 'full' eigendecomposition of the genes x genes covariance matrix
+        (cells x cells Gram matrix if there are at least as many genes as cells), or
+        'randomized' truncated SVD computing only n_components directly from the data, for
+        datasets whose covariance or Gram matrix does not fit in memory. Single cell data is
+        close to full rank, where the randomized SVD converges slowly: on 3,000 cells x 1,500
+        genes of log counts its 100 components match the full decomposition, on 20,000 x
+        3,000 only about the leading 20 do, later loadings mix components of similar variance.
+        n_components below 1 (a fraction of the variance) needs all eigenvalues and always
+        uses 'full'
+        :param random_state: Seed or np.random.RandomState of the randomized SVD, None for
+        an unseeded run
         """
+        if svd_solver not in ('full', 'randomized'):
+            raise ValueError('svd_solver must be \'full\' or \'randomized\'')
 
         X = self.data.values
         # Make sure data is zero mean
         X = np.subtract(X, np.amin(X))
         X = np.divide(X, np.amax(X))
 
+        if svd_solver == 'randomized' and n_components >= 1:
+            loadings, l = self._randomized_pca(X, n_components, random_state)
+            self.pca = {'loadings': pd.DataFrame(data=loadings, index=self.data.columns),
+                'eigenvalues': pd.DataFrame(l)}
+            return
+
         # Compute covariance matrix
         if (X.shape[1] < X.shape[0]):
             C = np.cov(X, rowvar=0)
@@ -373,6 +411,33 @@ class SCData:
         self.pca = {'loadings': loadings, 'eigenvalues': l}
 
 
+    @staticmethod
+    def _randomized_pca(X, n_components, random_state):
+        """ Truncated randomized SVD equivalent to the eigendecompositions of run_pca: of the
+        covariance matrix if there are fewer genes than cells, of the uncentered cells x cells
+        Gram matrix X X^T / N otherwise. The eigenvalues are the squared singular values
+        divided by N - 1 and N, the loadings the right singular vectors.
+        :param X: Scaled cells x genes array, modified in place
+        :return: genes x n_components loadings and the n_components eigenvalues
+        """
+        n_cells, n_genes = X.shape
+        if n_components > min(X.shape):
+            n_components = min(X.shape)
+            print('Target dimensionality reduced to ' + str(n_components) + '.')
+
+        # Undefined entries are dropped, as from the matrix of the full decomposition
+        X[~np.isfinite(X)] = 0
+        if n_genes < n_cells:
+            X -= np.mean(X, axis=0)
+            denominator = n_cells - 1
+        else:
+            denominator = n_cells
+        # the power iterations and oversampling needed on nearly full rank data
+        _, s, Vt = randomized_svd(X, n_components, n_oversamples=max(10, n_components),
+            n_iter=_RANDOMIZED_PCA_ITERATIONS, random_state=random_state)
+        return Vt.T, np.power(s, 2) / denominator
+
+
     def plot_pca_variance_explained(self, n_components=30,
             fig=None, ax=None, ylim=(0, 0.1)):
         """ Plot the variance explained by different principal components
@@ -397,13 +462,18 @@ class SCData:
 
 
 
-    def run_tsne(self, n_components=15, perplexity=30, rand_seed=-1):
+    def run_tsne(self, n_components=15, perplexity=30, rand_seed=-1, progress=None, cancel=None):
         """ Run tSNE on the data. tSNE is run on the principal component projections
         for single cell RNA-seq data and on the expression matrix for mass cytometry data
         :param n_components: Number of components to use for running tSNE for single cell
         RNA-seq data. Ignored for mass cytometry
+        :param progress: Called with a dictionary of the stage and the fraction done before
+        and after the embedding
+        :param cancel: wishbone.instrument.CancelToken checked before and after the embedding.
+        bhtsne offers no hook to stop the embedding itself
         :return: None
         """
+        instrument = Instrumentation(progress=progress, cancel=cancel)
 
         # Work on PCA projections if data is single cell RNA-seq
         data = deepcopy(self.data)
@@ -421,8 +491,10 @@ class SCData:
         if data.shape[0] < 100 and perplexity > perplexity_limit:
             print('Reducing perplexity to %d since there are <100 cells in the dataset. ' % perplexity_limit)
             perplexity = perplexity_limit
-        self.tsne = pd.DataFrame(bhtsne.tsne(data, perplexity=perplexity, rand_seed=rand_seed),
-                         index=self.data.index, columns=['x', 'y'])
+        instrument.update('tsne', 0.0)
+        tsne = bhtsne.tsne(data, perplexity=perplexity, rand_seed=rand_seed)
+        instrument.update('tsne', 1.0)
+        self.tsne = pd.DataFrame(tsne, index=self.data.index, columns=['x', 'y'])
 
 
     def plot_tsne(self, fig=None, ax=None, title='tSNE projection'):
@@ -567,7 +639,7 @@ class SCData:
 
 
     def run_diffusion_map(self, knn=10, epsilon=1,
-        n_diffusion_components=10, n_pca_components=15, markers=None):
+        n_diffusion_components=10, n_pca_components=15, markers=None, progress=None, cancel=None):
         """ Run diffusion maps on the data. Run on the principal component projections
         for single cell RNA-seq data and on the expression matrix for mass cytometry data
         :param knn: Number of neighbors for graph construction to determine distances between cells
@@ -575,8 +647,12 @@ class SCData:
         :param n_diffusion_components: Number of diffusion components to Generalte
         :param n_pca_components: Number of components to use for running tSNE for single cell
         RNA-seq data. Ignored for mass cytometry
+        :param progress: Called with a dictionary of the stage and the fraction done after
+        the nearest neighbors, the affinities and the eigendecomposition
+        :param cancel: wishbone.instrument.CancelToken stopping the computation between steps
         :return: None
         """
+        instrument = Instrumentation(progress=progress, cancel=cancel)
 
         data = deepcopy(self.data)
         if self.data_type == 'sc-seq':
@@ -584,8 +660,10 @@ class SCData:
                 raise RuntimeError('Please run PCA using run_pca before running diffusion maps for single cell RNA-seq')
 
             data = deepcopy(self.data)
-            data -= np.min(np.ravel(data))
-            data /= np.max(np.ravel(data))
+            offset = np.min(np.ravel(data))
+            data -= offset
+            scale = np.max(np.ravel(data))
+            data /= scale
             data = pd.DataFrame(np.dot(data, self.pca['loadings'].iloc[:, 0:n_pca_components]),
                                 index=self.data.index)
 
@@ -596,21 +674,16 @@ class SCData:
             data = deepcopy(self.data[markers])
 
         # Nearest neighbors
+        instrument.update('diffusion_map', 0.0)
         N = data.shape[0]
         nbrs = NearestNeighbors(n_neighbors=knn).fit(data)
         distances, indices = nbrs.kneighbors(data)
+        instrument.update('diffusion_map', 0.4)
 
-        # Adjacency matrix
-        rows = np.zeros(N * knn, dtype=np.int32)
-        cols = np.zeros(N * knn, dtype=np.int32)
-        dists = np.zeros(N * knn)
-        location = 0
-        for i in range(N):
-            inds = range(location, location + knn)
-            rows[inds] = indices[i, :]
-            cols[inds] = i
-            dists[inds] = distances[i, :]
-            location += knn
+        # Adjacency matrix, column i holds the neighbors of cell i
+        rows = indices.ravel().astype(np.int32)
+        cols = np.repeat(np.arange(N, dtype=np.int32), knn)
+        dists = distances.ravel()
         W = csr_matrix( (dists, (rows, cols)), shape=[N, N] )
 
         # Symmetrize W
@@ -632,10 +705,12 @@ class SCData:
         P = D
         T = D.dot(W).dot(D)
         T = (T + T.T) / 2
+        instrument.update('diffusion_map', 0.5)
 
 
         # Eigen value decomposition
         D, V = eigs(T, n_diffusion_components, tol=1e-4, maxiter=1000)
+        instrument.update('diffusion_map', 0.9)
         D = np.real(D)
         V = np.real(V)
         inds = np.argsort(D)[::-1]
@@ -647,10 +722,48 @@ class SCData:
         for i in range(V.shape[1]):
             V[:, i] = V[:, i] / norm(V[:, i])
         V = np.round(V, 10)
+        instrument.update('diffusion_map', 1.0)
 
         # Update object
         self.diffusion_eigenvectors = pd.DataFrame(V, index=self.data.index)
         self.diffusion_eigenvalues = pd.DataFrame(D)
+        self.diffusion_operator = {'nbrs': nbrs, 'knn': knn, 'epsilon': epsilon,
+            'n_pca_components': n_pca_components, 'markers': markers,
+            'offset': offset if self.data_type == 'sc-seq' else None,
+            'scale': scale if self.data_type == 'sc-seq' else None}
+
+
+    def project_diffusion_map(self, scdata):
+        """ Diffusion components of new cells by Nystrom extension of the diffusion map:
+        each component of a new cell is the affinity weighted average of the component over
+        its nearest cells, divided by the eigenvalue
+        :param scdata: SCData object with the new cells, normalized like this object
+        :return: DataFrame of new cells x diffusion components
+        """
+        if self.diffusion_operator is None:
+            raise RuntimeError('Please run diffusion maps using run_diffusion_map before projecting cells')
+        op = self.diffusion_operator
+
+        # Map the new cells into the space the diffusion map was computed in
+        if self.data_type == 'sc-seq':
+            missing = self.data.columns.difference(scdata.data.columns)
+            if len(missing) > 0:
+                raise RuntimeError('%d genes of the fitted data are missing from the new data' % len(missing))
+            data = (scdata.data[self.data.columns].values - op['offset']) / op['scale']
+            data = np.dot(data, self.pca['loadings'].iloc[:, 0:op['n_pca_components']])
+        else:
+            data = scdata.data[op['markers']].values
+
+        # Affinities to the nearest cells, normalized to transition probabilities
+        distances, indices = op['nbrs'].kneighbors(data, n_neighbors=op['knn'])
+        P = np.exp(-distances / (op['epsilon'] ** 2))
+        P /= P.sum(axis=1)[:, np.newaxis]
+
+        V = self.diffusion_eigenvectors.values
+        D = np.ravel(self.diffusion_eigenvalues.values)
+        V_new = np.einsum('ij,ijk->ik', P, V[indices]) / D
+        return pd.DataFrame(V_new, index=scdata.data.index,
+            columns=self.diffusion_eigenvectors.columns)
 
 
     def plot_diffusion_components(self, title='Diffusion Components'):
@@ -795,7 +908,7 @@ class SCData:
         print('Please specify the gmt_file parameter as gmt_file=(organism, filename)')
 
     @staticmethod
-    def _gsea_process(c, diffusion_map_correlations, output_stem, gmt_file):
+    def _gsea_process(c, diffusion_map_correlations, output_stem, gmt_file, instrument=None):
 
         # save the .rnk file
         out_dir, out_prefix = os.path.split(output_stem)
@@ -821,9 +934,17 @@ class SCData:
                       out_prefix=out_prefix, component=c, out_dir=out_dir,
                       gmt_file=gmt_file))
 
-        # Call GSEA
+        # Call GSEA, stopping it if the run is cancelled
         p = Popen(cmd, stderr=PIPE)
-        _, err = p.communicate()
+        while True:
+            try:
+                _, err = p.communicate(timeout=_GSEA_POLL_INTERVAL)
+                break
+            except TimeoutExpired:
+                if instrument is not None and instrument.cancel is not None and instrument.cancel.cancelled:
+                    p.kill()
+                    p.communicate()
+                    instrument.check()
 
         # remove annoying suffix from GSEA
         if err:
@@ -844,15 +965,18 @@ class SCData:
             return b'GSEA output pattern was not found, and could not be changed.'
 
     def run_gsea(self, output_stem, gmt_file=None,
-        components=None, enrichment_threshold=1e-1):
+        components=None, enrichment_threshold=1e-1, progress=None, cancel=None):
         """ Run GSEA using gene rankings from diffusion map correlations
 
         :param output_stem: the file location and prefix for the output of GSEA
         :param gmt_file: GMT file containing the gene sets. Use None to see a list of options
         :param components: Iterable of integer component numbers
         :param enrichment_threshold: FDR corrected p-value significance threshold for gene set enrichments
+        :param progress: Called with a dictionary of the stage and the fraction of components done
+        :param cancel: wishbone.instrument.CancelToken. A cancelled run stops the running GSEA process
         :return: Dictionary containing the top enrichments for each component
         """
+        instrument = Instrumentation(progress=progress, cancel=cancel)
 
         out_dir, out_prefix = os.path.split(output_stem)
         out_dir += '/'
@@ -876,9 +1000,10 @@ class SCData:
         # Run GSEA
         print('If running in notebook, please look at the command line window for GSEA progress log')
         reports = dict()
-        for c in components:
+        instrument.update('gsea', 0.0)
+        for i, c in enumerate(components):
             res = self._gsea_process( c, self._diffusion_map_correlations,
-                output_stem, gmt_file )
+                output_stem, gmt_file, instrument )
             # Load results
             if res == b'':
                 # Positive correlations
@@ -891,6 +1016,7 @@ class SCData:
                 df = pd.DataFrame.from_csv(glob.glob(output_stem + '_%d/gsea*neg*xls' % c)[0], sep='\t')
                 reports[c]['neg'] = df['FDR q-val'][0:5]
                 reports[c]['neg'] = reports[c]['neg'][reports[c]['neg'] < enrichment_threshold]
+            instrument.update('gsea', (i + 1) / len(components))
 
         # Return results
         return reports
@@ -953,6 +1079,7 @@ class Wishbone:
         self._branch = None
         self._waypoints = None
         self._branch_colors = None
+        self._model = None
 
     def __repr__(self):
         c, g = self.scdata.data.shape
@@ -1037,17 +1164,61 @@ class Wishbone:
             raise TypeError('self.branch_colors a pd.Series object')
         self._branch_colors = item
 
+    @property
+    def model(self):
+        return self._model
+
+    @model.setter
+    def model(self, item):
+        if not (isinstance(item, WishboneModel) or item is None):
+            raise TypeError('self.model must be a WishboneModel object')
+        self._model = item
+
 
     def run_wishbone(self, start_cell, branch=True, k=15,
-        components_list=[1, 2, 3], num_waypoints=250):
+        components_list=[1, 2, 3], num_waypoints=250, n_jobs=1, dtype=np.float64,
+        nn_backend='exact', cache=None, waypoint_strategy='random', landmark_subsample=None,
+        instrument=None, progress=None, cancel=None, fit_model=False):
         """ Function to run Wishbone.
         :param start_cell: Desired start cell. This has to be a cell in self.scdata.index
         :param branch: Use True for Wishbone and False for Wanderlust
         :param k: Number of nearest neighbors for graph construction
         :param components_list: List of components to use for running Wishbone
         :param num_waypoints: Number of waypoints to sample
-        :return:
+        :param n_jobs: Number of threads for the per-waypoint computations, and of worker
+        processes for the shortest paths from the waypoints. Use -1 for all cores
+        :param dtype: Floating point type of the computation. np.float32 halves memory use;
+        trajectories then agree with np.float64 to about 1e-5, or about 1e-2 when the
+        realignment converges one iteration earlier or later, with the same branches
+        :param nn_backend: Nearest neighbor search: 'exact', 'approximate' for a random projection
+        forest with neighbor descent (wishbone.neighbors.ApproximateNeighbors), or an object with
+        the fit and kneighbors methods of sklearn.neighbors.NearestNeighbors, e.g. an
+        ApproximateNeighbors instance with custom recall/speed settings. 'approximate' only pays
+        off for 8 to about 15 components and 100,000 cells or more; below 8 components exact
+        search is used instead, with a warning
+        :param cache: wishbone.core.GraphCache shared between calls on the same diffusion components.
+        Graphs and waypoint shortest paths are then reused, e.g. when only start_cell changes
+        :param waypoint_strategy: 'random' sampling of waypoints, 'farthest' point sampling over
+        graph distances or 'density' stratified sampling along the distance from the start cell.
+        'farthest' gives stable results with far fewer waypoints, e.g. 50 instead of 250
+        :param landmark_subsample: Fast mode for large datasets. If not None, the iterative
+        refinement runs on about this many cells around the waypoints and the result is
+        extended to all cells in a final pass
+        :param instrument: Per-stage timing and peak memory of the run (graph construction,
+        waypoints, shortest paths, every iteration, branch split and muting). A callable
+        receiving every event as a dictionary, the path of a JSON run report or a
+        wishbone.instrument.Instrumentation
+        :param progress: Called with a dictionary of the stage, the fraction of it done and the
+        graph index, per block of landmarks, per waypoint and per iteration
+        :param cancel: wishbone.instrument.CancelToken. The run raises wishbone.instrument.Cancelled
+        once it is cancelled or its time budget has passed
+        :param fit_model: Also set self.model for projecting new cells (see WishboneModel).
+        The model keeps the waypoint x cell shortest path distances in memory and needs the
+        operator state of the diffusion map (scdata.diffusion_operator)
+        :return: None
         """
+        if fit_model and self.scdata.diffusion_operator is None:
+            raise RuntimeError('fit_model needs the diffusion operator, please rerun run_diffusion_map')
 
         # Start cell index
         s = np.where(self.scdata.diffusion_eigenvectors.index == start_cell)[0]
@@ -1064,22 +1235,72 @@ class Wishbone:
 
         # Run the algorithm
         res = wishbone.core.wishbone(
-            self.scdata.diffusion_eigenvectors.ix[:, components_list].values,
-            s=s, k=k, l=k, num_waypoints=num_waypoints, branch=branch)
+            self.scdata.diffusion_eigenvectors.ix[:, components_list].values.astype(dtype),
+            s=s, k=k, l=k, num_waypoints=num_waypoints, branch=branch, n_jobs=n_jobs,
+            dtype=dtype, nn_backend=nn_backend, cache=cache, waypoint_strategy=waypoint_strategy,
+            landmark_subsample=landmark_subsample,
+            keep_landmarks=fit_model, instrument=instrument,
+            progress=progress, cancel=cancel)
 
         # Assign results
         trajectory = res['Trajectory']
         branches = res['Branches']
-        trajectory = (trajectory - np.min(trajectory)) / (np.max(trajectory) - np.min(trajectory))
+        trajectory = (trajectory - np.nanmin(trajectory)) / (np.nanmax(trajectory) - np.nanmin(trajectory))
         self.trajectory = pd.Series(trajectory, index=self.scdata.data.index)
         self.branch = None
         if branch:
             self.branch = pd.Series([np.int(i) for i in branches], index=self.scdata.data.index)
         self.waypoints = list(self.scdata.data.index[res['Waypoints']])
 
-        # Set branch colors
+        # Set branch colors, grey for the cells outside the component of the start cell
         if branch:
             self.branch_colors = dict( zip([2, 1, 3], qualitative_colors(3)))
+            self.branch_colors[0] = 'lightgrey'
+
+        # Fitted model for new cells
+        self.model = None
+        if fit_model:
+            self.model = WishboneModel(self.scdata, components_list, k, res['Landmarks'])
+
+
+    def run_wishbone_batch(self, start_cells, branch=True, k=15,
+        components_list=[1, 2, 3], num_waypoints=250, n_jobs=1, dtype=np.float64,
+        nn_backend='exact', cache=None, waypoint_strategy='random', landmark_subsample=None,
+        instrument=None, progress=None, cancel=None):
+        """ Run Wishbone from several start cells, sharing the graph, the waypoints and
+        their shortest paths between all of them. Results are returned and not assigned
+        to the object.
+        :param start_cells: List of start cells. These have to be cells in self.scdata.index
+        :param num_waypoints: Number of waypoints to sample, shared by all start cells
+        Remaining parameters as in run_wishbone.
+        :return: Dictionary of start cell to a DataFrame with the trajectory and branch columns
+        """
+
+        # Start cell indices
+        index = self.scdata.diffusion_eigenvectors.index
+        missing = [c for c in start_cells if c not in index]
+        if len(missing) > 0:
+            raise RuntimeError('Start cells %s not found in data. Please rerun with correct start cells' % missing)
+        if not isinstance(num_waypoints, int) or num_waypoints > self.scdata.data.shape[0]:
+            raise RuntimeError('num_waypoints must be a number of cells lower than the number of cells in the dataset')
+        starts = [np.where(index == c)[0][0] for c in start_cells]
+
+        # Run the algorithm
+        results = wishbone.core.wishbone_batch(
+            self.scdata.diffusion_eigenvectors.ix[:, components_list].values.astype(dtype),
+            starts, k=k, l=k, num_waypoints=num_waypoints, branch=branch, n_jobs=n_jobs,
+            dtype=dtype, nn_backend=nn_backend, cache=cache, waypoint_strategy=waypoint_strategy,
+            landmark_subsample=landmark_subsample, instrument=instrument,
+            progress=progress, cancel=cancel)
+
+        runs = dict()
+        for cell, res in zip(start_cells, results):
+            trajectory = res['Trajectory']
+            trajectory = (trajectory - np.nanmin(trajectory)) / (np.nanmax(trajectory) - np.nanmin(trajectory))
+            runs[cell] = pd.DataFrame({'trajectory': trajectory,
+                'branch': res['Branches'] if branch else np.nan},
+                index=self.scdata.data.index, columns=['trajectory', 'branch'])
+        return runs
 
 
     # Plotting functions
@@ -1137,8 +1358,10 @@ class Wishbone:
         # if self.scdata.data_type == 'sc-seq' and show_variance:
         #     raise RuntimeError('Variance calculation is currently not supported for single-cell RNA-seq')
 
-        # Compute bin locations and bin memberships
-        trajectory = self.trajectory.copy()
+        # Compute bin locations and bin memberships of the cells on the trajectory,
+        # cells outside the component of the start cell have none
+        trajectory = self.trajectory.dropna()
+        branch = self.branch[trajectory.index] if self.branch is not None else None
         # Sort trajectory
         trajectory = trajectory.sort_values()
         bins = np.linspace(np.min(trajectory), np.max(trajectory), no_bins)
@@ -1151,20 +1374,20 @@ class Wishbone:
 
 
         # Adjust weights if data has branches
-        if self.branch is not None:
+        if branch is not None:
 
             plot_branch = True
 
             # Branch of the trunk
-            trunk = self.branch[trajectory.index[0]]
-            branches = list( set( self.branch).difference([trunk]))
+            trunk = branch[trajectory.index[0]]
+            branches = list( set( branch).difference([trunk]))
             linetypes = pd.Series([':', '--'], index=branches)
 
 
             # Counts of branch cells in each bin
             branch_counts = pd.DataFrame(np.zeros([len(bins)-1, 3]), columns=[1, 2, 3])
             for j in branch_counts.columns:
-                branch_counts[j] = pd.Series([sum(self.branch[trajectory.index[(trajectory > bins[i-1]) & \
+                branch_counts[j] = pd.Series([sum(branch[trajectory.index[(trajectory > bins[i-1]) & \
                     (trajectory < bins[i])]] == j) for i in range(1, len(bins))])
             # Frequencies
             branch_counts = branch_counts.divide( branch_counts.sum(axis=1), axis=0)
@@ -1254,7 +1477,7 @@ class Wishbone:
                 for br in branches:
                     # Mute weights of the branch cells and plot
                     weights = weights_copy.copy()
-                    weights.ix[self.branch.index[self.branch == br], :] = 0
+                    weights.ix[branch.index[branch == br], :] = 0
 
                     plot_vals = ((rep_mark * weights)/np.sum(weights)).sum()
                     branch_vals.append( plot_vals[(bp_bin-1):] )
@@ -1316,8 +1539,8 @@ class Wishbone:
                         if bp_bin < smooth_bins:
                             smooth_bins = bp_bin - 1
                         for i in range(smooth_bins):
-                            weights.ix[self.branch == br, bp_bin + i - smooth_bins] *= ((smooth_bins - i)/smooth_bins) * 0.25
-                        weights.ix[self.branch == br, (bp_bin):weights.shape[1]] = 0
+                            weights.ix[branch == br, bp_bin + i - smooth_bins] *= ((smooth_bins - i)/smooth_bins) * 0.25
+                        weights.ix[branch == br, (bp_bin):weights.shape[1]] = 0
 
                         # Calculate values to be plotted
                         plot_vals = ((rep_mark * weights)/np.sum(weights)).sum()
@@ -1516,3 +1739,51 @@ class Wishbone:
             plt.xlabel( 'Wishbone trajectory' )
 
         return fig, ax
+
+
+class WishboneModel:
+
+    def __init__(self, scdata, components_list, k, landmarks):
+        """
+        Fitted Wishbone model placing new cells on the trajectory. Created by
+        Wishbone.run_wishbone with fit_model=True.
+        :param scdata: SCData object Wishbone was run on, with its diffusion operator
+        :param components_list: Diffusion components Wishbone was run on
+        :param k: Number of nearest neighbors of the Wishbone graph
+        :param landmarks: Landmark state returned by wishbone.core.wishbone
+        """
+        self._scdata = scdata
+        self._components_list = list(components_list)
+        self._k = k
+        self._landmarks = landmarks
+        self._nbrs = NearestNeighbors(n_neighbors=k).fit(
+            scdata.diffusion_eigenvectors.ix[:, self._components_list].values)
+
+    @property
+    def scdata(self):
+        return self._scdata
+
+    @property
+    def waypoints(self):
+        return list(self.scdata.data.index[self._landmarks['waypoints']])
+
+    def project(self, scdata):
+        """ Trajectory and branches of new cells. Diffusion components of the new cells are
+        obtained by Nystrom extension and their distances to the waypoints through their
+        nearest fitted cells. The data of the new cells must be normalized and transformed
+        like the data of the fitted cells.
+        :param scdata: SCData object with the new cells
+        :return: DataFrame of new cells with the trajectory and branch columns
+        """
+        if not isinstance(scdata, SCData):
+            raise TypeError('scdata must be of type wishbone.wb.SCData')
+        if scdata.data_type != self.scdata.data_type:
+            raise RuntimeError('New cells must be of data type %s' % self.scdata.data_type)
+
+        components = self.scdata.project_diffusion_map(scdata)
+        distances, indices = self._nbrs.kneighbors(
+            components.ix[:, self._components_list].values)
+        trajectory, branches = wishbone.core.project_cells(self._landmarks, distances, indices)
+        return pd.DataFrame({'trajectory': trajectory,
+            'branch': branches if branches is not None else np.nan},
+            index=scdata.data.index, columns=['trajectory', 'branch'])